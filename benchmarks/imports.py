@@ -0,0 +1,69 @@
+"""Import time of the simulation core, checked against a budget.
+
+Every import runs in a fresh interpreter, a few times to keep the fastest. The
+cost of the core is measured over that of torch and numpy alone, which it
+cannot avoid, and importing it must not load the web app, plotting or R.
+
+    python -m benchmarks.imports --budget 0.5
+"""
+import argparse
+import json
+import subprocess
+import sys
+
+
+CORE = ('retail', 'retail.store', 'retail.store.store_env',
+        'retail.store.batched_store_env', 'retail.store.rollout', 'retail.utility')
+
+# Loaded on first use only, never by the core
+HEAVY = ('dash', 'dash_bootstrap_components', 'dash_core_components',
+         'dash_html_components', 'pandas', 'plotly', 'rpy2')
+
+_PROBE = '''
+import json, sys, time
+start = time.perf_counter()
+for name in {modules!r}:
+    __import__(name)
+elapsed = time.perf_counter() - start
+print(json.dumps({{'seconds': elapsed, 'loaded': [name for name in {heavy!r}
+                                                  if name in sys.modules]}}))
+'''
+
+
+def measure(modules, repeat=3):
+    """Fastest import time of modules in a fresh interpreter, and the heavy modules loaded"""
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.check_output([sys.executable, '-c', _PROBE.format(
+            modules=tuple(modules), heavy=HEAVY)])
+        runs.append(json.loads(output.decode().strip().splitlines()[-1]))
+    return min(runs, key=lambda run: run['seconds'])
+
+
+def check(budget=.5, repeat=3):
+    """Prints the import cost of the core and returns the budget violations"""
+    base = measure(('numpy', 'torch'), repeat)
+    core = measure(CORE, repeat)
+    overhead = core['seconds'] - base['seconds']
+    print('torch and numpy {:.2f}s, core {:.2f}s, overhead {:.2f}s (budget {:.2f}s)'.format(
+        base['seconds'], core['seconds'], overhead, budget))
+    violations = ['loads ' + name for name in core['loaded']]
+    if overhead > budget:
+        violations.append('overhead {:.2f}s over {:.2f}s'.format(overhead, budget))
+    return violations
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--budget', type=float, default=.5,
+                        help='seconds allowed over importing torch and numpy')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args(argv)
+    violations = check(args.budget, args.repeat)
+    if violations:
+        print('Import budget exceeded: ' + ', '.join(violations))
+    return 1 if violations else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,382 @@
+"""StoreEnv throughput, latency and memory over a grid of configurations.
+
+Every configuration runs in a fresh process, so that construction time and peak
+RSS are not shared between them. Items come from the in-process copula with a
+fixed seed, so results are reproducible and do not need R.
+
+    python -m benchmarks.store_env run --assortment-size 100 1000 --output new.json
+    python -m benchmarks.store_env compare base.json new.json
+
+Compiled step kernels must give the results of eager steps, which parity
+checks over the configurations they cover:
+
+    python -m benchmarks.store_env parity --step-kernel script compile
+
+Stock engines and the NumPy backend must give the results of dense torch
+stores, including when orders overflow max_stock again and again, which
+engines checks:
+
+    python -m benchmarks.store_env engines --freshness 10 30
+
+BatchedStoreEnv is compared with stepping as many StoreEnvs in a loop:
+
+    python -m benchmarks.store_env batched --n-stores 50 --assortment-size 20 100
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+
+GRID = {
+    'assortment_size': [100, 1000],
+    'max_stock': [100, 1000],
+    'substep_count': [4],
+    'customers': [2500],
+    'lead_time': [1],
+    'utility_function': ['homogeneous'],
+    'step_kernel': ['eager'],
+}
+
+# Values of the parameters added to GRID since the first result files
+DEFAULTS = {'step_kernel': 'eager'}
+
+PARITY_GRID = {
+    'step_kernel': ['script'],
+    'stock_engine': ['dense', 'histogram'],
+    'demand_model': ['binomial', 'poisson'],
+    'utility_function': ['linear', 'loglinear', 'cobbdouglas', 'homogeneous'],
+    'lead_time_fast': [0, 1],
+}
+
+# Orders overflowing max_stock again and again, over the shelf lives of
+# freshness 10 and more, extend the same units repeatedly
+ENGINE_GRID = {
+    'max_stock': [20, 100],
+    'freshness': [1, 10, 30],
+    'order': ['forecast*n_customers - stock', '2*forecast*n_customers - stock',
+              '3*forecast*n_customers'],
+    'carriers': ['none', 'two'],
+    'utility_function': ['homogeneous', 'cobbdouglas'],
+    'lead_time_fast': [0, 1],
+}
+
+# Carriers of ENGINE_GRID, one delivering on the day for lead_time_fast=0
+CARRIERS = {'none': (), 'two': ((2e5, 250., 0), (3e5, 500., 1))}
+
+BATCHED_GRID = {
+    'n_stores': [50],
+    'assortment_size': [20, 100, 1000],
+    'max_stock': [100],
+    'stock_engine': ['dense', 'histogram'],
+}
+
+
+def run_config(config, steps, warmup, seed, order):
+    # Runs in its own process, see run
+    os.environ['RETAIL_ASSORTMENT_CACHE_DIR'] = ''
+    start = time.perf_counter()
+    import torch
+
+    from retail.store.profiling import StepProfiler
+    from retail.store.rollout import expression_policy
+    from retail.store.store_env import StoreEnv
+    import_time = time.perf_counter() - start
+
+    torch.manual_seed(seed)
+    torch.set_num_threads(1)
+    config = dict(config)
+    customers = config.pop('customers')
+    substeps = config['substep_count']
+    start = time.perf_counter()
+    env = StoreEnv(seed=seed, horizon=warmup + 2 * steps,
+                   bucket_customers=torch.full((substeps, ), customers / substeps),
+                   bucket_cov=torch.eye(substeps) / 100, **config)
+    construction_time = time.perf_counter() - start
+
+    policy = expression_policy(order, customers)
+    with torch.no_grad():
+        for _ in range(warmup):
+            env.step(policy(env))
+        start = time.perf_counter()
+        for _ in range(steps):
+            env.step(policy(env))
+        elapsed = time.perf_counter() - start
+        with StepProfiler(env) as profiler:
+            for _ in range(steps):
+                env.step(policy(env))
+
+    return {
+        'import_s': import_time,
+        'construction_s': construction_time,
+        'steps_per_s': steps / elapsed,
+        'phases': profiler.stats(),
+        # kilobytes on Linux, bytes on macOS
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        / (2 ** 20 if sys.platform == 'darwin' else 2 ** 10),
+    }
+
+
+def run(grid, steps=200, warmup=20, seed=1, order='forecast*n_customers - stock'):
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for values in itertools.product(*grid.values()):
+        config = dict(zip(grid, values))
+        with context.Pool(1) as pool:
+            result = pool.apply(run_config, (config, steps, warmup, seed, order))
+        print(_describe(config), '{:.1f} steps/s, built in {:.2f}s, {:.0f} MB'.format(
+            result['steps_per_s'], result['construction_s'], result['peak_rss_mb']),
+            file=sys.stderr)
+        results.append(dict(config=config, **result))
+    return {'meta': _meta(steps, warmup, seed, order), 'results': results}
+
+
+def run_batched(config, steps, warmup, seed, order):
+    # Runs in its own process, see batched
+    os.environ['RETAIL_ASSORTMENT_CACHE_DIR'] = ''
+    import torch
+
+    from retail.store.batched_store_env import BatchedStoreEnv
+    from retail.store.rollout import expression_policy
+    from retail.store.store_env import StoreEnv
+
+    torch.manual_seed(seed)
+    torch.set_num_threads(1)
+    config = dict(config)
+    n_stores = config.pop('n_stores')
+    kwargs = dict(seed=seed, horizon=warmup + steps, **config)
+    stores = [StoreEnv(**kwargs) for _ in range(n_stores)]
+    batched = BatchedStoreEnv(n_stores, **kwargs)
+    policy = expression_policy(order, int(batched.bucket_customers.sum()))
+
+    def loop():
+        for env in stores:
+            env.step(policy(env))
+
+    def batch():
+        batched.step(policy(batched))
+
+    seconds = {}
+    with torch.no_grad():
+        for step in (loop, batch):
+            for _ in range(warmup):
+                step()
+            start = time.perf_counter()
+            for _ in range(steps):
+                step()
+            seconds[step.__name__] = time.perf_counter() - start
+    return {'loop_steps_per_s': n_stores * steps / seconds['loop'],
+            'batched_steps_per_s': n_stores * steps / seconds['batch'],
+            'speedup': seconds['loop'] / seconds['batch']}
+
+
+def batched(grid, steps=50, warmup=5, seed=1, order='forecast*n_customers - stock'):
+    """Store steps per second of looped StoreEnvs and of a BatchedStoreEnv"""
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for values in itertools.product(*grid.values()):
+        config = dict(zip(grid, values))
+        with context.Pool(1) as pool:
+            result = pool.apply(run_batched, (config, steps, warmup, seed, order))
+        print(_describe(config), '{:.0f} -> {:.0f} store steps/s, {:.1f}x'.format(
+            result['loop_steps_per_s'], result['batched_steps_per_s'], result['speedup']),
+            file=sys.stderr)
+        results.append(dict(config=config, **result))
+    return {'meta': _meta(steps, warmup, seed, order), 'results': results}
+
+
+def check_parity(config, steps=100, seed=1, order='forecast*n_customers - stock'):
+    """First difference between eager steps and those of config['step_kernel'], None if none"""
+    import torch
+
+    from retail.store.rollout import expression_policy
+    from retail.store.store_env import EnvInfo, StoreEnv
+
+    runs = []
+    for step_kernel in ('eager', config['step_kernel']):
+        torch.manual_seed(seed)
+        env = StoreEnv(seed=seed, horizon=steps, assortment_size=50, max_stock=100,
+                       **dict(config, step_kernel=step_kernel))
+        if step_kernel != 'eager' and env._kernel is None:
+            return 'no {} kernel'.format(step_kernel)
+        policy = expression_policy(order, int(env.bucket_customers.sum()))
+        outcomes = []
+        with torch.no_grad():
+            for _ in range(steps):
+                (obs, reward, _, info) = env.step(policy(env))
+                outcomes.append([obs.clone(), reward] + list(info[:4]))
+        runs.append(outcomes)
+    for (step, outcomes) in enumerate(zip(*runs)):
+        for (name, (eager, kernel)) in zip(('obs', 'reward') + EnvInfo._fields[:4],
+                                           zip(*outcomes)):
+            if not torch.equal(torch.as_tensor(eager), torch.as_tensor(kernel)):
+                return '{} of step {}'.format(name, step)
+    return None
+
+
+def check_engines(config, steps=150, seed=1):
+    """First differences of the other engines and backends from dense torch stores, None if none"""
+    import torch
+
+    from retail.store.numpy_store_env import NumpyStoreEnv
+    from retail.store.rollout import expression_policy
+    from retail.store.store_env import EnvInfo, StoreEnv
+
+    kwargs = dict(config, carriers=CARRIERS[config['carriers']])
+    order = kwargs.pop('order')
+    runs = {}
+    for (backend, stock_engine) in itertools.product((StoreEnv, NumpyStoreEnv),
+                                                     ('dense', 'histogram')):
+        torch.manual_seed(seed)
+        env = backend(seed=seed, horizon=steps, assortment_size=50, stock_engine=stock_engine,
+                      **kwargs)
+        policy = expression_policy(order, int(env.bucket_customers.sum()))
+        outcomes = []
+        with torch.no_grad():
+            for _ in range(steps):
+                (obs, reward, _, info) = env.step(policy(env))
+                outcomes.append([torch.as_tensor(value).clone()
+                                 for value in [obs, reward] + list(info[:4])])
+        runs['{} {}'.format(backend.__name__, stock_engine)] = outcomes
+    reference = runs.pop('StoreEnv dense')
+    differences = []
+    for (name, outcomes) in runs.items():
+        for (step, (expected, got)) in enumerate(zip(reference, outcomes)):
+            fields = [field for (field, a, b) in zip(('obs', 'reward') + EnvInfo._fields[:4],
+                                                     expected, got)
+                      if not torch.equal(a, b)]
+            if fields:
+                differences.append('{}: {} of step {}'.format(name, ', '.join(fields), step))
+                break
+    return '; '.join(differences) or None
+
+
+def compare(base, new, threshold=.1):
+    """Prints the change of every shared configuration, returns the regressions"""
+    base_results = {_describe(dict(DEFAULTS, **r['config'])): r for r in base['results']}
+    regressions = []
+    for result in new['results']:
+        name = _describe(dict(DEFAULTS, **result['config']))
+        if name not in base_results:
+            continue
+        old = base_results[name]
+        change = result['steps_per_s'] / old['steps_per_s'] - 1
+        print('{}: {:.1f} -> {:.1f} steps/s ({:+.1%}), build {:.2f}s -> {:.2f}s, '
+              'RSS {:.0f} -> {:.0f} MB'.format(
+                  name, old['steps_per_s'], result['steps_per_s'], change,
+                  old['construction_s'], result['construction_s'],
+                  old['peak_rss_mb'], result['peak_rss_mb']))
+        if change < -threshold:
+            regressions.append(name)
+    return regressions
+
+
+def _describe(config):
+    return ' '.join('{}={}'.format(key, value) for (key, value) in sorted(config.items()))
+
+
+def _meta(steps, warmup, seed, order):
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    import torch
+    return {'commit': commit, 'python': platform.python_version(),
+            'torch': torch.__version__, 'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'steps': steps,
+            'warmup': warmup, 'seed': seed, 'order': order}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    commands = parser.add_subparsers(dest='command')
+    sweep = commands.add_parser('run', help='run the grid')
+    for (name, default) in GRID.items():
+        sweep.add_argument('--' + name.replace('_', '-'), nargs='+', default=default,
+                           type=type(default[0]))
+    sweep.add_argument('--steps', type=int, default=200)
+    sweep.add_argument('--warmup', type=int, default=20)
+    sweep.add_argument('--seed', type=int, default=1)
+    sweep.add_argument('--order', default='forecast*n_customers - stock')
+    sweep.add_argument('--output', help='JSON file, stdout by default')
+    parity = commands.add_parser('parity', help='compare kernel and eager steps')
+    for (name, default) in PARITY_GRID.items():
+        parity.add_argument('--' + name.replace('_', '-'), nargs='+', default=default,
+                            type=type(default[0]))
+    parity.add_argument('--steps', type=int, default=100)
+    parity.add_argument('--seed', type=int, default=1)
+    engines = commands.add_parser('engines', help='compare stock engines and backends')
+    for (name, default) in ENGINE_GRID.items():
+        engines.add_argument('--' + name.replace('_', '-'), nargs='+', default=default,
+                             type=type(default[0]))
+    engines.add_argument('--steps', type=int, default=150)
+    engines.add_argument('--seed', type=int, default=1)
+    batch = commands.add_parser('batched', help='compare BatchedStoreEnv with looped stores')
+    for (name, default) in BATCHED_GRID.items():
+        batch.add_argument('--' + name.replace('_', '-'), nargs='+', default=default,
+                           type=type(default[0]))
+    batch.add_argument('--steps', type=int, default=50)
+    batch.add_argument('--warmup', type=int, default=5)
+    batch.add_argument('--seed', type=int, default=1)
+    batch.add_argument('--output', help='JSON file, stdout by default')
+    diff = commands.add_parser('compare', help='compare two result files')
+    diff.add_argument('base')
+    diff.add_argument('new')
+    diff.add_argument('--threshold', type=float, default=.1,
+                      help='relative slowdown counted as a regression')
+    args = parser.parse_args(argv)
+
+    if args.command == 'compare':
+        with open(args.base) as f, open(args.new) as g:
+            regressions = compare(json.load(f), json.load(g), args.threshold)
+        if regressions:
+            print('Regressions: ' + ', '.join(regressions))
+        return 1 if regressions else 0
+    elif args.command == 'parity':
+        failures = []
+        for values in itertools.product(*(getattr(args, name) for name in PARITY_GRID)):
+            config = dict(zip(PARITY_GRID, values))
+            difference = check_parity(config, args.steps, args.seed)
+            print(_describe(config), difference or 'same', file=sys.stderr)
+            if difference:
+                failures.append(_describe(config))
+        if failures:
+            print('Parity failures: ' + ', '.join(failures))
+        return 1 if failures else 0
+    elif args.command == 'engines':
+        failures = []
+        for values in itertools.product(*(getattr(args, name) for name in ENGINE_GRID)):
+            config = dict(zip(ENGINE_GRID, values))
+            difference = check_engines(config, args.steps, args.seed)
+            print(_describe(config), difference or 'same', file=sys.stderr)
+            if difference:
+                failures.append(_describe(config))
+        if failures:
+            print('Engine differences: ' + ', '.join(failures))
+        return 1 if failures else 0
+    elif args.command in ('run', 'batched'):
+        if args.command == 'run':
+            grid = {name: getattr(args, name) for name in GRID}
+            results = run(grid, args.steps, args.warmup, args.seed, args.order)
+        else:
+            grid = {name: getattr(args, name) for name in BATCHED_GRID}
+            results = batched(grid, args.steps, args.warmup, args.seed)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=1)
+        else:
+            json.dump(results, sys.stdout, indent=1)
+        return 0
+    parser.print_help()
+    return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,12 +1,26 @@
+import importlib
 import logging
 
-import dash
 
-from .retail_traj_info import RetailTrajInfo
-from .layout import serve_layout_func
+# Attributes imported on first access, so that the simulation core loads
+# without the web app or rlpyt samplers
+_LAZY = {
+    'RetailTrajInfo': '.retail_traj_info',
+    'serve_layout_func': '.layout',
+}
+
+
+def __getattr__(name):
+    if name not in _LAZY:
+        raise AttributeError("module '{}' has no attribute '{}'".format(__name__, name))
+    return getattr(importlib.import_module(_LAZY[name], __name__), name)
 
 
 def create_app():
+    import dash
+
+    from .layout import serve_layout_func
+
     # Initialize logging
     logging.basicConfig(level=logging.INFO, format='[%(asctime)s] [%(levelname)s] %(message)s')
     logging.info('Initialized logging')
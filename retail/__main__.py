@@ -3,11 +3,14 @@ import os
 
 import dash
 from dash.dependencies import Input, Output, State
-from pymemcache.client.base import Client
-from pymemcache import serde
 
 from . import create_app
+from .cache import create_cache
+from .jobs import JobQueue
+from .results import ResultCache
 from .store import StoreFactory
+from .store.numpy_store_env import set_num_threads
+from .store.store_env import plot_daily_rewards
 
 
 # Dash server
@@ -16,10 +19,18 @@ app = create_app()
 # Flask server (for gunicorn)
 server = app.server
 
-# Cache server
-memcached_server = os.getenv('MEMCACHED_SERVER', 'localhost')
-cache = Client(memcached_server, serde=serde.pickle_serde)
-logging.info("Initialized client with memcached server at: %s", memcached_server)
+# Small interactive stores step faster on NumPy, and gain nothing from the
+# thread pools of app workers sharing the machine
+BACKEND = os.getenv('RETAIL_BACKEND', 'numpy')
+set_num_threads(int(os.getenv('RETAIL_NUM_THREADS', 1)))
+
+# Session cache, memcached at MEMCACHED_SERVER or in-process
+cache = create_cache()
+
+# Simulations run in worker processes, polled by the page
+jobs = JobQueue(cache, ResultCache(cache),
+                max_workers=int(os.getenv('RETAIL_JOB_WORKERS', 2)),
+                profile=bool(os.getenv('RETAIL_PROFILE')))
 
 
 @app.callback(
@@ -61,44 +72,80 @@ def update_output_div(n_clicks, session_id, n_customers, n_items, max_stock,
         return dash.no_update
 
     # Create StoreEnv
-    store = StoreFactory.create_store_env(
-        n_customers, n_items, max_stock, horizon, freshness, seed, utility_fun,
-        utility, weight_waste, weight_sales, weight_availability, bias,
-        variance, leadtime_long, leadtime_fast, daily_buckets)
+    try:
+        store = StoreFactory.create_store_env(
+            n_customers, n_items, max_stock, horizon, freshness, seed,
+            utility_fun, utility, weight_waste, weight_sales,
+            weight_availability, bias, variance, leadtime_long, leadtime_fast,
+            daily_buckets, backend=BACKEND)
+    except ValueError as e:
+        logging.warning("Rejected store parameters: %s", e)
+        return dash.no_update
 
     # Save to cache
     logging.info("Saving to cache under session ID: %s", session_id)
     cache.set(session_id, store, expire=300)
 
-    # Get some stats
+    # Get some stats, as last sampled
     stats = cache.stats()
-    logging.info("Current cache size after save: %d items, %.1f MB",
-                 stats[b'curr_items'], stats[b'bytes']/1000000.)
+    if stats:
+        logging.info("Current cache size: %d items, %.1f MB",
+                     stats['curr_items'], stats['bytes']/1000000.)
 
     # Scatter plot
     return store.assortment.scatter_plot()
 
 
 @app.callback(
-    Output('output2', 'figure'),
+    Output('job-id', 'children'),
     [Input('order_button', 'n_clicks'),
     Input('session-id', 'children')],
     state=[State('n_customers', 'value'),
-           State('horizon', 'value'),
            State('order', 'value')])
-def update_output_order(n_clicks, session_id, n_customers, horizon, order):
+def update_output_order(n_clicks, session_id, n_customers, order):
     if n_clicks is None:
         return dash.no_update
 
     # Retrieve from cache
     logging.info("Retrieving from cache using session ID: %s", session_id)
     store = cache.get(session_id)
+    if store is None:
+        logging.warning("No store cached under session ID: %s", session_id)
+        return dash.no_update
+
+    # Queue RL simulation
+    try:
+        job_id = jobs.submit(session_id, store, order, n_customers)
+    except ValueError as e:
+        logging.warning("Rejected order policy: %s", e)
+        return dash.no_update
+    logging.info("Queued simulation job %s for session ID: %s", job_id, session_id)
+    return job_id
 
-    # Run RL simulation
-    rewards = store.run_to_completion(order, n_customers)
 
-    # Plot rewards
-    return store.plot_rewards(rewards, horizon)
+@app.callback(
+    [Output('output2', 'figure'),
+    Output('job-status', 'children'),
+    Output('job-poll', 'disabled')],
+    [Input('job-poll', 'n_intervals'),
+    Input('job-id', 'children')])
+def poll_order_job(n_intervals, job_id):
+    # Also fired by new jobs, so that it alone turns polling on and off
+    if job_id is None:
+        return dash.no_update, dash.no_update, True
+
+    state = jobs.status(job_id)
+    if state is None:
+        return dash.no_update, 'Simulation expired', True
+    if state['status'] == 'queued':
+        return dash.no_update, 'Simulation queued', False
+    if state['status'] in ('failed', 'cancelled', 'rejected'):
+        return dash.no_update, 'Simulation {}'.format(state['status']), True
+
+    # Plot rewards, partial ones while running
+    done = state['status'] == 'done'
+    status = '' if done else 'Simulating: {:.0%}'.format(state['progress'])
+    return plot_daily_rewards(state['daily']), status, done
 
 
 if __name__ == '__main__':
@@ -0,0 +1,183 @@
+from collections import OrderedDict
+import logging
+import os
+import pickle
+import threading
+import time
+import uuid
+
+
+# Leading byte of stored values
+_INLINE = b'\x00'
+_CHUNKED = b'\x01'
+
+
+class LocalCache:
+    """In-process LRU cache, bounded to `capacity` bytes of pickled values.
+
+    Values are pickled like with memcached, so that callers mutating what they
+    get never alter the cached copy. Sessions are only shared by the threads of
+    one process, which suits tests and single-worker deployments.
+    """
+
+    def __init__(self, capacity=256 * 2 ** 20):
+        self.capacity = capacity
+        self._items = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def set(self, key, value, expire=0):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        deadline = time.monotonic() + expire if expire else None
+        with self._lock:
+            self._pop(key)
+            self._items[key] = (data, deadline)
+            self._size += len(data)
+            while self._size > self.capacity and self._items:
+                self._pop(next(iter(self._items)))
+        return True
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._items:
+                return None
+            (data, deadline) = self._items[key]
+            if deadline is not None and deadline < time.monotonic():
+                self._pop(key)
+                return None
+            self._items.move_to_end(key)
+        return pickle.loads(data)
+
+    def delete(self, key):
+        with self._lock:
+            self._pop(key)
+
+    def stats(self):
+        with self._lock:
+            return {'curr_items': len(self._items), 'bytes': self._size}
+
+    def _pop(self, key):
+        if key in self._items:
+            self._size -= len(self._items.pop(key)[0])
+
+
+class MemcacheCache:
+    """memcached client with pooled connections, retries and chunked values.
+
+    Values are pickled, and those over `chunk_size` bytes are split over several
+    keys behind a header naming them, so that sessions larger than the slab size
+    are stored instead of being dropped. stats() returns the figures sampled
+    every `stats_interval` seconds by a background thread, keeping that round
+    trip off the request path.
+    """
+
+    def __init__(self, server, max_pool_size=8, retries=2, timeout=2.,
+                 chunk_size=1000 * 1000 - 1024, stats_interval=30.):
+        from pymemcache.client.base import PooledClient
+        from pymemcache.exceptions import MemcacheError
+
+        self.server = server
+        self.retries = retries
+        self.chunk_size = chunk_size
+        self.stats_interval = stats_interval
+        self._client = PooledClient(server, max_pool_size=max_pool_size,
+                                    connect_timeout=timeout, timeout=timeout,
+                                    no_delay=True)
+        self._errors = (OSError, MemcacheError)
+        self._stats = {}
+        self._stats_thread = None
+        self._lock = threading.Lock()
+
+    def set(self, key, value, expire=0):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if len(data) < self.chunk_size:
+            return self._call('set', key, _INLINE + data, expire, noreply=False)
+        # Chunk keys are unique to this write, so readers never mix two versions
+        token = uuid.uuid4().hex
+        chunks = {'{}:{}:{}'.format(key, token, i): data[start:start + self.chunk_size]
+                  for (i, start) in enumerate(range(0, len(data), self.chunk_size))}
+        failed = self._call('set_many', chunks, expire, noreply=False)
+        if failed is None or failed:
+            return False
+        header = pickle.dumps(list(chunks))
+        return self._call('set', key, _CHUNKED + header, expire, noreply=False)
+
+    def get(self, key):
+        data = self._call('get', key)
+        if not data:
+            return None
+        if data[:1] == _INLINE:
+            return pickle.loads(data[1:])
+        names = pickle.loads(data[1:])
+        chunks = self._call('get_many', names) or {}
+        if len(chunks) != len(names):
+            return None
+        return pickle.loads(b''.join(chunks[name] for name in names))
+
+    def delete(self, key):
+        self._call('delete', key, noreply=False)
+
+    def stats(self):
+        with self._lock:
+            if self._stats_thread is None:
+                # Started on first use, so that it runs in forked workers
+                self._stats_thread = threading.Thread(target=self._sample_stats,
+                                                      daemon=True)
+                self._stats_thread.start()
+            return dict(self._stats)
+
+    def ping(self):
+        try:
+            self._client.version()
+            return True
+        except self._errors:
+            return False
+
+    def _call(self, method, *args, **kwargs):
+        for attempt in range(self.retries + 1):
+            try:
+                return getattr(self._client, method)(*args, **kwargs)
+            except self._errors as e:
+                if attempt == self.retries:
+                    logging.warning("memcached %s on %s failed: %s", method,
+                                    self.server, e)
+                    return None
+                time.sleep(0.05 * 2 ** attempt)
+
+    def _sample_stats(self):
+        while True:
+            stats = self._call('stats')
+            if stats is not None:
+                stats = {key.decode() if isinstance(key, bytes) else key: value
+                         for (key, value) in stats.items()}
+                with self._lock:
+                    self._stats = stats
+            time.sleep(self.stats_interval)
+
+
+def create_cache(server=None, local_fallback=None):
+    """Cache for the app: memcached at MEMCACHED_SERVER, or a LocalCache when it
+    is set to an empty string.
+
+    A server that does not answer yet is still used, its client reconnecting on
+    later calls, so that app workers never split sessions and jobs between
+    caches. Set RETAIL_LOCAL_CACHE to fall back to a LocalCache instead, which
+    only suits a single worker.
+    """
+    if server is None:
+        server = os.getenv('MEMCACHED_SERVER', 'localhost')
+    if local_fallback is None:
+        local_fallback = bool(os.getenv('RETAIL_LOCAL_CACHE'))
+    if not server:
+        return LocalCache()
+    cache = MemcacheCache(server)
+    if cache.ping():
+        logging.info("Initialized client with memcached server at: %s", server)
+        return cache
+    if local_fallback:
+        logging.warning("memcached server at %s is unreachable, sessions are "
+                        "only cached within this process", server)
+        return LocalCache()
+    logging.error("memcached server at %s is unreachable, sessions and jobs are "
+                  "lost until it answers", server)
+    return cache
@@ -0,0 +1,175 @@
+import ast
+import functools
+from math import e, pi
+
+import torch
+import torch.nn.functional as F
+
+
+# Variables available to the expressions typed in the web app
+
+ORDER_VARIABLES = ('forecast', 'n_customers', 'customers', 'stock', 'std')
+UTILITY_VARIABLES = ('s', 'w', 'a')
+
+
+def _elementwise(function):
+    def wrapped(x, *args, **kwargs):
+        return function(torch.as_tensor(x), *args, **kwargs)
+    return wrapped
+
+
+def _binary(function):
+    def wrapped(x, y):
+        return function(*_broadcast(x, y))
+    return wrapped
+
+
+def _broadcast(x, y):
+    (x, y) = (torch.as_tensor(x), torch.as_tensor(y))
+    if x.dtype == y.dtype:
+        return (x, y)
+    if hasattr(torch, 'promote_types'):
+        dtype = torch.promote_types(x.dtype, y.dtype)
+    else:
+        dtype = torch.get_default_dtype()
+    return (x.to(dtype), y.to(dtype))
+
+
+FUNCTIONS = {
+    'abs': _elementwise(torch.abs),
+    'ceil': _elementwise(torch.ceil),
+    'clamp': _elementwise(torch.clamp),
+    'cos': _elementwise(torch.cos),
+    'exp': _elementwise(torch.exp),
+    'floor': _elementwise(torch.floor),
+    'log': _elementwise(torch.log),
+    'log1p': _elementwise(torch.log1p),
+    'max': _binary(torch.max),
+    'min': _binary(torch.min),
+    'relu': _elementwise(F.relu),
+    'round': _elementwise(torch.round),
+    'sigmoid': _elementwise(torch.sigmoid),
+    'sign': _elementwise(torch.sign),
+    'sin': _elementwise(torch.sin),
+    'sqrt': _elementwise(torch.sqrt),
+    'tanh': _elementwise(torch.tanh),
+    'where': lambda condition, x, y: torch.where(torch.as_tensor(condition),
+                                                 *_broadcast(x, y)),
+}
+# Required and optional arguments of the functions not taking a single one,
+# optional ones also accepted as keywords
+SIGNATURES = {
+    'clamp': (('x', ), ('min', 'max')),
+    'max': (('x', 'y'), ()),
+    'min': (('x', 'y'), ()),
+    'where': (('condition', 'x', 'y'), ()),
+}
+CONSTANTS = {'e': e, 'pi': pi}
+MODULES = ('torch', 'F', 'np')
+
+_OPERATORS = (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.Mod,
+              ast.FloorDiv, ast.UAdd, ast.USub, ast.Lt, ast.LtE, ast.Gt,
+              ast.GtE, ast.Eq, ast.NotEq)
+
+
+class CompiledExpression:
+    """Arithmetic expression over whitelisted variables, parsed and checked once.
+
+    Only numbers, the given variables, arithmetic and comparison operators and the
+    elementwise functions of FUNCTIONS (also reachable as torch.f, F.f or np.f),
+    called with the arguments of SIGNATURES, are accepted. Calling it evaluates the
+    precompiled code with the variables as keyword arguments.
+    """
+
+    def __init__(self, text, variables):
+        self.text = text
+        self.variables = tuple(variables)
+        try:
+            tree = ast.parse(text.strip(), mode='eval')
+        except SyntaxError as error:
+            raise ValueError("Invalid expression '{}': {}".format(text, error.msg))
+        tree = _Checker(self.variables).visit(tree)
+        self.canonical = ast.dump(tree)
+        self._code = compile(ast.fix_missing_locations(tree), '<expression>', 'eval')
+
+    def __call__(self, **variables):
+        namespace = dict(FUNCTIONS, **CONSTANTS)
+        namespace.update(variables)
+        return eval(self._code, {'__builtins__': {}}, namespace)
+
+    def __reduce__(self):
+        return (compile_expression, (self.text, self.variables))
+
+
+class _Checker(ast.NodeTransformer):
+    # Rejects anything outside the whitelist and rewrites torch.f(x) as f(x)
+
+    def __init__(self, variables):
+        self.variables = variables
+
+    def generic_visit(self, node):
+        if not isinstance(node, (ast.Expression, ast.BinOp, ast.UnaryOp,
+                                 ast.Compare, ast.Call, ast.Name, ast.Load,
+                                 ast.keyword) + _OPERATORS):
+            raise ValueError("'{}' is not allowed in expressions".format(type(node).__name__))
+        return super().generic_visit(node)
+
+    def visit_Constant(self, node):
+        if isinstance(node.value, bool) or not isinstance(node.value, (int, float)):
+            raise ValueError("Only numbers are allowed as constants, got {!r}".format(node.value))
+        # Floats keep constant powers from blowing up into huge integers
+        return ast.copy_location(ast.Constant(value=float(node.value)), node)
+
+    def visit_Num(self, node):
+        return self.visit_Constant(ast.copy_location(ast.Constant(value=node.n), node))
+
+    def visit_Compare(self, node):
+        if len(node.ops) > 1:
+            raise ValueError('Chained comparisons are not supported on tensors')
+        return self.generic_visit(node)
+
+    def visit_Name(self, node):
+        if node.id not in self.variables and node.id not in CONSTANTS:
+            raise ValueError("Unknown variable '{}', expected one of {}".format(
+                node.id, ', '.join(self.variables)))
+        return node
+
+    def visit_Call(self, node):
+        function = node.func
+        if isinstance(function, ast.Attribute) and isinstance(function.value, ast.Name) \
+                and function.value.id in MODULES:
+            name = function.attr
+        elif isinstance(function, ast.Name):
+            name = function.id
+        else:
+            raise ValueError('Only calls to elementwise functions are allowed')
+        if name not in FUNCTIONS:
+            raise ValueError("Unknown function '{}', expected one of {}".format(
+                name, ', '.join(sorted(FUNCTIONS))))
+        (required, optional) = SIGNATURES.get(name, (('x', ), ()))
+        if not len(required) <= len(node.args) <= len(required) + len(optional):
+            raise ValueError("'{}' takes {}, got {}".format(
+                name, _count(len(required), len(required) + len(optional)), len(node.args)))
+        for keyword in node.keywords:
+            # Leaving out those already given as positional arguments
+            if keyword.arg not in optional[len(node.args) - len(required):]:
+                raise ValueError("Unknown keyword argument '{}' of '{}'".format(
+                    keyword.arg, name))
+        if optional and len(node.args) + len(node.keywords) == len(required):
+            raise ValueError("'{}' needs at least one of {}".format(name, ', '.join(optional)))
+        node.func = ast.copy_location(ast.Name(id=name, ctx=ast.Load()), function)
+        node.args = [self.visit(arg) for arg in node.args]
+        node.keywords = [self.visit(keyword) for keyword in node.keywords]
+        return node
+
+
+def _count(low, high):
+    if low != high:
+        return '{} to {} arguments'.format(low, high)
+    return '1 argument' if low == 1 else '{} arguments'.format(low)
+
+
+@functools.lru_cache(maxsize=256)
+def compile_expression(text, variables):
+    """Cached CompiledExpression, raising ValueError for invalid expressions"""
+    return CompiledExpression(text, variables)
@@ -0,0 +1,207 @@
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import hashlib
+import logging
+import multiprocessing
+import pickle
+import queue
+import threading
+import time
+
+import torch
+
+from retail.expression import ORDER_VARIABLES, compile_expression
+from retail.store.profiling import StepProfiler
+from retail.store.rollout import expression_policy, rollout
+
+
+# Cache key prefixes of job states and of the last job of each session
+_JOB = 'job:'
+_SESSION = 'session-job:'
+_CANCEL = 'cancel-job:'
+
+# Queue of state updates sent by the workers, set by _init_worker
+_updates = None
+
+
+class JobQueue:
+    """Simulations run on a bounded process pool, with their state in the cache.
+
+    submit returns a job ID right away, and status(job_id) gives the last state
+    stored for it: a dict with a 'status' among queued, running, done, failed,
+    cancelled and rejected, a 'progress' fraction and the 'daily' utility values
+    simulated so far. Workers send their updates to a thread of this process,
+    which writes them to the cache in order, so that any app worker sharing the
+    cache can answer the polls. Given a ResultCache, seeded simulations run once
+    and repeated ones are done as soon as submitted. With profile, workers log
+    the time spent in each phase of the store steps of every job.
+    """
+
+    def __init__(self, cache, results=None, max_workers=2, max_pending=16,
+                 expire=600, update_interval=.5, profile=False):
+        self.cache = cache
+        self.results = results
+        self.profile = profile
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.expire = expire
+        self.update_interval = update_interval
+        self._pool = None
+        self._updates = None
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def submit(self, session_id, store, order, n_customers):
+        # Rejects invalid policies before queuing anything
+        compile_expression(order, ORDER_VARIABLES)
+        payload = pickle.dumps(store, pickle.HIGHEST_PROTOCOL)
+        job_id = hashlib.sha1(pickle.dumps((session_id, payload, order, n_customers))).hexdigest()
+
+        previous = self.cache.get(_SESSION + session_id)
+        if previous == job_id and self._active(job_id):
+            return job_id
+        if previous is not None:
+            self.cancel(previous)
+
+        self.cache.set(_SESSION + session_id, job_id, expire=self.expire)
+        result_key = None
+        if self.results is not None:
+            result_key = self.results.key(store, order, n_customers)
+            daily = None if result_key is None else self.results.get(result_key)
+            if daily is not None:
+                self._set_state(job_id, 'done', progress=1., daily=daily)
+                return job_id
+        with self._lock:
+            self._futures = {key: future for (key, future) in self._futures.items()
+                             if not future.done()}
+            if len(self._futures) >= self.max_pending:
+                logging.warning("Job queue full, rejecting job %s", job_id)
+                self._set_state(job_id, 'rejected')
+                return job_id
+            self._start()
+            self._set_state(job_id, 'queued')
+            args = (job_id, payload, order, n_customers, self.update_interval, result_key,
+                    self.profile)
+            try:
+                future = self._pool.submit(_run, *args)
+            except BrokenProcessPool:
+                logging.warning("A job worker died, restarting the job pool")
+                self._start(broken=True)
+                future = self._pool.submit(_run, *args)
+            future.add_done_callback(lambda future: self._finished(job_id, future))
+            self._futures[job_id] = future
+        return job_id
+
+    def status(self, job_id):
+        return self.cache.get(_JOB + job_id)
+
+    def cancel(self, job_id):
+        """Cancels a queued job, running ones complete.
+
+        Jobs queued by other processes sharing the cache are flagged there,
+        and cancelled by their own queue with its next update.
+        """
+        with self._lock:
+            future = self._futures.get(job_id)
+        if future is None:
+            if self._active(job_id):
+                self.cache.set(_CANCEL + job_id, True, expire=self.expire)
+        elif future.cancel():
+            self._set_state(job_id, 'cancelled')
+
+    def _active(self, job_id):
+        state = self.status(job_id)
+        return state is not None and state['status'] in ('queued', 'running')
+
+    def _set_state(self, job_id, status, **state):
+        state.update(status=status)
+        self.cache.set(_JOB + job_id, state, expire=self.expire)
+
+    def _finished(self, job_id, future):
+        # Workers report their own results, only pool failures end up here
+        if not future.cancelled() and future.exception() is not None:
+            self._updates.put((job_id, {'status': 'failed',
+                                        'error': str(future.exception())}, None))
+
+    def _start(self, broken=False):
+        # Started on first use, so that they belong to the forked app workers,
+        # and the pool again once a dead worker broke it for good
+        if broken:
+            # Through the queue, after the updates of the jobs before they failed
+            for job_id in self._futures:
+                self._updates.put((job_id, {'status': 'failed',
+                                            'error': 'job worker died'}, None))
+            self._futures = {}
+            self._pool.shutdown(wait=False)
+            self._pool = None
+        if self._updates is None:
+            self._updates = multiprocessing.Queue()
+            threading.Thread(target=self._write_updates, daemon=True).start()
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(self.max_workers,
+                                             initializer=_init_worker,
+                                             initargs=(self._updates, ))
+
+    def _cancel_flagged(self):
+        # Queued jobs whose cancel came through another process
+        with self._lock:
+            queued = [(job_id, future) for (job_id, future) in self._futures.items()
+                      if not future.running() and not future.done()]
+        for (job_id, future) in queued:
+            if self.cache.get(_CANCEL + job_id) and future.cancel():
+                self._set_state(job_id, 'cancelled')
+
+    def _write_updates(self):
+        while True:
+            try:
+                self._cancel_flagged()
+                try:
+                    (job_id, state, result_key) = self._updates.get(
+                        timeout=self.update_interval)
+                except queue.Empty:
+                    continue
+                self.cache.set(_JOB + job_id, state, expire=self.expire)
+                if result_key is not None and state['status'] == 'done':
+                    self.results.set(result_key, state['daily'])
+            except Exception:
+                # The thread must outlive a flaky cache, or jobs stall as running
+                logging.exception("Could not write job updates to the cache")
+                time.sleep(self.update_interval)
+
+
+def _init_worker(updates):
+    global _updates
+    _updates = updates
+    torch.set_num_threads(1)
+
+
+def _run(job_id, payload, order, n_customers, update_interval, result_key,
+         profile):
+    last_update = [0.]
+
+    def progress(step, steps, trajectory):
+        now = time.monotonic()
+        if step % trajectory.substep_count == 0 and now - last_update[0] > update_interval:
+            last_update[0] = now
+            _updates.put((job_id, {'status': 'running', 'progress': step / steps,
+                                   'daily': trajectory.daily().tolist()}, None))
+
+    try:
+        start = time.monotonic()
+        store = pickle.loads(payload)
+        profiler = StepProfiler(store)
+        if profile:
+            profiler.start()
+        try:
+            trajectory = rollout(store, expression_policy(order, n_customers),
+                                 progress=progress, seed=store._seed)
+        finally:
+            profiler.stop()
+        state = {'status': 'done', 'progress': 1., 'daily': trajectory.daily().tolist()}
+        if profile:
+            logging.info("Job %s simulated in %.2fs: %s", job_id,
+                         time.monotonic() - start, profiler.summary())
+    except Exception as e:
+        logging.exception("Job %s failed", job_id)
+        state = {'status': 'failed', 'error': str(e)}
+    _updates.put((job_id, state, result_key))
@@ -143,6 +143,9 @@ def serve_layout_func(img):
                     ]),
                     html.Br(),
                     html.Button('Order!', id='order_button'),
+                    html.Div(id='job-id', style={'display': 'none'}),
+                    html.Div(id='job-status'),
+                    dcc.Interval(id='job-poll', interval=1000, disabled=True),
                     dcc.Graph(id='output2'),
                 ], label="ORDERING SIMULATION"),
             ]),
@@ -0,0 +1,74 @@
+import hashlib
+
+import numpy as np
+import torch
+
+from retail.expression import ORDER_VARIABLES, compile_expression
+from retail.store.state import unpack_values
+from retail.utility import CustomUtility
+
+
+# Cache key prefix of simulation results
+_RESULT = 'result:'
+
+
+class ResultCache:
+    """Daily utility series of seeded simulations, shared through the session cache.
+
+    A seeded store simulated with its seed always yields the same series, so
+    results are keyed by a hash of everything the store is pickled with, its
+    parameters as well as its stock, order buffers, episode counters and
+    seasonality phases, and of the normalized order and utility expressions.
+    Stores fresh from StoreFactory thus share results, while stepped, forked or
+    restored ones get their own. Series are
+    stored as float32 bytes, those over `max_item_bytes` are not cached, and
+    eviction is left to the cache, which bounds the bytes it holds.
+    """
+
+    def __init__(self, cache, expire=24 * 3600, max_item_bytes=256 * 1024):
+        self.cache = cache
+        self.expire = expire
+        self.max_item_bytes = max_item_bytes
+
+    def key(self, store, order, n_customers):
+        """Hash of a simulation, None when it is not reproducible"""
+        if store._seed is None:
+            return None
+        # The state jobs restore the store from, the global RNG being reseeded
+        state = store.__getstate__()
+        (params, mutable) = (unpack_values(state['params']), unpack_values(state['state']))
+        material = (type(store).__name__,
+                    [(name, _canonical(params[name])) for name in sorted(params)],
+                    [(name, _canonical(mutable[name])) for name in sorted(mutable)],
+                    compile_expression(order, ORDER_VARIABLES).canonical,
+                    float(n_customers))
+        return hashlib.sha1(repr(material).encode()).hexdigest()
+
+    def get(self, key):
+        data = self.cache.get(_RESULT + key)
+        if data is None:
+            return None
+        return np.frombuffer(data, dtype='<f4').tolist()
+
+    def set(self, key, daily):
+        data = np.asarray(daily, dtype='<f4').tobytes()
+        if len(data) <= self.max_item_bytes:
+            self.cache.set(_RESULT + key, data, expire=self.expire)
+
+
+def _canonical(value):
+    if isinstance(value, torch.Tensor):
+        return ('tensor', str(value.dtype), tuple(value.shape), value.tolist())
+    elif isinstance(value, CustomUtility):
+        return ('custom', value._expression.canonical)
+    elif isinstance(value, dict):
+        return ('dict', [(key, _canonical(value[key])) for key in sorted(value)])
+    elif isinstance(value, (list, tuple)):
+        return ('list', [_canonical(item) for item in value])
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    elif isinstance(value, (str, bool, type(None))):
+        return value
+    elif hasattr(value, '__dict__'):
+        return (type(value).__qualname__, _canonical(vars(value)))
+    return repr(value)
@@ -1 +1,18 @@
-from .store_factory import StoreFactory
+import importlib
+
+
+# Loaded on first access, see retail._LAZY
+_LAZY = {
+    'BatchedStoreEnv': '.batched_store_env',
+    'NumpyStoreEnv': '.numpy_store_env',
+    'StoreEnv': '.store_env',
+    'StoreFactory': '.store_factory',
+    'TrajectoryDataset': '.dataset',
+    'TrajectoryWriter': '.dataset',
+}
+
+
+def __getattr__(name):
+    if name not in _LAZY:
+        raise AttributeError("module '{}' has no attribute '{}'".format(__name__, name))
+    return getattr(importlib.import_module(_LAZY[name], __name__), name)
@@ -1,41 +1,74 @@
+import functools
 import os
+import tempfile
 
 import numpy as np
-import pandas as pd
-
-import plotly.express as px
 import torch
 
-from .util import Rscript
+from .assortment_cache import assortment_cache, file_digest
+from .catalog import product_catalog
+from .copula import ClaytonCopula, MODEL_PATH
+from .state import STATE_VERSION, check_version, pack, pack_values, unpack, unpack_values
 
 
-name_df = pd.read_csv('Grocery_UPC_Database.csv')
+ITEM_COLUMNS = ['Length', 'Depth', 'Height', 'Shelf_life', 'Base_Demand', 'Cost', 'Price']
 
 
 class Assortment:
 
-    def __init__(self, size, freshness=1, seed=None):
+    def __init__(self, size, freshness=1, seed=None, backend='numpy'):
         self.size = size
         self.freshness = freshness
         self.seed = seed
+        self.backend = backend
 
-        file_path = os.path.dirname(os.path.abspath(__file__))
-        Rscript(size, seed, file_path)
-
-        path_to_csv = os.path.join(file_path, 'assortment.csv')
-        df = pd.read_csv(path_to_csv)
-        self.selling_price = torch.tensor(df.Price)
-        self.cost = torch.tensor(df.Cost)
+        if seed is None:
+            table = _sample_items(size, seed, backend)
+        else:
+            key = (backend, size, seed, _model_digest(backend))
+            table = assortment_cache.get(key, lambda: _sample_items(size, seed, backend))
+        items = dict(zip(ITEM_COLUMNS, torch.from_numpy(np.array(table).T.copy())))
+        self.selling_price = items['Price']
+        self.cost = items['Cost']
 
         # clamp base demand as some outliers in the data generation might ruin the purchase probability
 
-        self.base_demand = torch.tensor(df.Base_Demand).clamp(0, 1000)
-        self.shelf_lives = torch.round(torch.tensor(df.Shelf_life,
-                                                    dtype=torch.float32)/freshness)
-        self.dims = torch.tensor(df.iloc[:, 1:4].values)
+        self.base_demand = items['Base_Demand'].clamp(0, 1000)
+        self._generated_base_demand = self.base_demand
+        self.shelf_lives = torch.round(items['Shelf_life'].float()/freshness)
+        self.dims = torch.stack((items['Length'], items['Depth'],
+                                 items['Height'])).t()
         self.characs = torch.stack((self.selling_price, self.cost,
                                     self.shelf_lives)).t()
 
+    def __getstate__(self):
+        # Seeded tables are regenerated through the assortment cache on load
+        state = {'version': STATE_VERSION, 'size': self.size,
+                 'freshness': self.freshness, 'seed': self.seed,
+                 'backend': self.backend}
+        if self.seed is None or self.base_demand is not self._generated_base_demand:
+            state['base_demand'] = pack(self.base_demand)
+        if self.seed is None:
+            state['items'] = pack_values({
+                'selling_price': self.selling_price, 'cost': self.cost,
+                'shelf_lives': self.shelf_lives, 'dims': self.dims})
+        return state
+
+    def __setstate__(self, state):
+        check_version(state, 'Assortment')
+        if 'items' in state:
+            (self.size, self.freshness, self.seed, self.backend) = \
+                (state['size'], state['freshness'], state['seed'], state['backend'])
+            self.__dict__.update(unpack_values(state['items']))
+            self._generated_base_demand = None
+            self.characs = torch.stack((self.selling_price, self.cost,
+                                        self.shelf_lives)).t()
+        else:
+            self.__init__(state['size'], state['freshness'], state['seed'],
+                          state['backend'])
+        if 'base_demand' in state:
+            self.base_demand = unpack(state['base_demand'])
+
     # Functions for further improvement
 
     def changePrices(self, new_prices):
@@ -55,14 +88,18 @@ class Assortment:
         return NotImplemented
 
     def to_dataframe(self):
+        import pandas as pd
+
         return pd.DataFrame({
             'Cost': np.round(self.cost.numpy(), 2),
             'Price': np.round(self.selling_price.numpy(), 2),
             'Shelf life at purchase': self.shelf_lives.numpy(),
-            'Name': name_df.sample(self.size).values.tolist(),
+            'Name': product_catalog.sample(self.size, self.seed),
         })
 
     def scatter_plot(self):
+        import plotly.express as px
+
         sc = px.scatter(self.to_dataframe(),
                         x='Cost', y='Price', color='Shelf life at purchase',
                         title='Generated items at your store', hover_name='Name',
@@ -73,3 +110,39 @@ class Assortment:
         sc.update_yaxes(tickprefix="€")
         sc.update_xaxes(tickprefix="€")
         return sc
+
+
+@functools.lru_cache()
+def _copula():
+    return ClaytonCopula()
+
+
+def _model_digest(backend):
+    if backend == 'numpy':
+        return file_digest(MODEL_PATH)
+    elif backend == 'r':
+        return file_digest(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                        'copulaModel.RData'))
+    else:
+        raise ValueError("Unknown assortment backend '{}'".format(backend))
+
+
+def _sample_items(size, seed, backend):
+    # (size x ITEM_COLUMNS) table of generated items
+    if backend == 'numpy':
+        sampler = _copula()
+        items = sampler.sample(size, seed)
+        return items[:, [sampler.columns.index(c) for c in ITEM_COLUMNS]]
+    elif backend == 'r':
+        # Reference backend, sampling the copula with R itself
+        import pandas as pd
+
+        from .util import Rscript
+
+        file_path = os.path.dirname(os.path.abspath(__file__))
+        with tempfile.TemporaryDirectory() as out_path:
+            Rscript(size, seed, file_path, out_path)
+            df = pd.read_csv(os.path.join(out_path, 'assortment.csv'))
+        return df[ITEM_COLUMNS].values
+    else:
+        raise ValueError("Unknown assortment backend '{}'".format(backend))
@@ -0,0 +1,91 @@
+from collections import OrderedDict
+import functools
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+
+import numpy as np
+
+
+class AssortmentCache:
+    """Sampled assortment tables keyed by their generation parameters.
+
+    The first tier is an in-memory LRU bounded to `capacity` tables, the second
+    one .npy files in `directory`, written atomically and memory-mapped on load
+    so that concurrent workers can share them. Only seeded assortments are cached.
+    """
+
+    def __init__(self, capacity=32, directory=None):
+        self.capacity = capacity
+        self.directory = directory
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, generate):
+        """Table stored under key, calling generate() to build it on a miss"""
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        with self._lock:
+            if digest in self._memory:
+                self._memory.move_to_end(digest)
+                return self._memory[digest]
+        table = self._load(digest)
+        if table is None:
+            table = generate()
+            self._save(digest, table)
+        with self._lock:
+            self._memory[digest] = table
+            while len(self._memory) > self.capacity:
+                self._memory.popitem(last=False)
+        return table
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+
+    def _load(self, digest):
+        if self.directory is None:
+            return None
+        try:
+            return np.load(os.path.join(self.directory, digest + '.npy'),
+                           mmap_mode='r')
+        except (OSError, ValueError):
+            return None
+
+    def _save(self, digest, table):
+        if self.directory is None:
+            return
+        try:
+            save_atomic(os.path.join(self.directory, digest + '.npy'), table)
+        except OSError as e:
+            logging.warning("Could not write assortment cache to %s: %s",
+                            self.directory, e)
+
+
+def save_atomic(path, array):
+    """np.save through a temporary file, so readers never see a partial array"""
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    (fd, tmp_path) = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, array)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+@functools.lru_cache()
+def file_digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+assortment_cache = AssortmentCache(
+    capacity=int(os.getenv('RETAIL_ASSORTMENT_CACHE_SIZE', 32)),
+    directory=os.getenv('RETAIL_ASSORTMENT_CACHE_DIR',
+                        os.path.join(os.path.expanduser('~'), '.cache', 'retail',
+                                     'assortments')) or None,
+)
@@ -0,0 +1,67 @@
+import torch
+
+from rlpyt.spaces.int_box import IntBox
+from rlpyt.spaces.float_box import FloatBox
+
+from .stock import DenseStock, HistogramStock
+from .store_env import StoreEnv
+
+
+class BatchedStoreEnv(StoreEnv):
+    """N independent stores sharing one assortment, advanced by a single step call.
+
+    Stock, order buffers, forecasts and customer buckets carry a leading store
+    dimension: step takes actions of shape (n_stores, assortment_size) and returns
+    rewards, infos and done flags per store. bucket_customers may be given per
+    store as an (n_stores, buckets) tensor, which needs a demand model drawing
+    per-item totals (any but 'bernoulli'). All stores share the intraday position,
+    while reset can restart the episode of any subset of them. With random
+    streams, every store draws from streams of its own.
+    Batching saves the per-step overhead of every store, which dominates small
+    stores, while large ones step about as fast as in a loop, see
+    benchmarks/store_env.py batched.
+    """
+
+    def __init__(self, n_stores, **kwargs):
+        self._batch_shape = (n_stores, )
+        self.n_stores = n_stores
+        super().__init__(**kwargs)
+        self._step_counter = torch.zeros(n_stores, dtype=torch.long)
+        self._episode = torch.zeros(n_stores, dtype=torch.long)
+
+        if self._symmetric_action_space:
+            self._action_space = FloatBox(low=-self._max_stock / 2,
+                                          high=self._max_stock / 2,
+                                          shape=[n_stores, self._assortment_size])
+        else:
+            self._action_space = IntBox(low=0, high=self._max_stock,
+                                        shape=[n_stores, self._assortment_size])
+        self._observation_space = FloatBox(low=0, high=1000,
+                                           shape=(n_stores, ) + self._obs.shape[1:])
+
+    def reset(self, index=None):
+        if index is None:
+            self._step_counter.zero_()
+            self._episode += 1
+        else:
+            self._step_counter[index] = 0
+            self._episode[index] += 1
+        self._updateObs()
+        return self.get_obs()
+
+    # ##########################################################################
+    # Helpers
+
+    def _get_init_params(self):
+        return dict(super()._get_init_params(), n_stores=self.n_stores)
+
+    def _createStock(self, stock_engine):
+        if stock_engine == 'dense':
+            return DenseStock(self.assortment.shelf_lives, self._max_stock,
+                              batch_shape=self._batch_shape)
+        elif stock_engine == 'histogram':
+            return HistogramStock(self.assortment.shelf_lives, self._max_stock,
+                                  batch_shape=self._batch_shape)
+        else:
+            return stock_engine(self.assortment.shelf_lives, self._max_stock,
+                                batch_shape=self._batch_shape)
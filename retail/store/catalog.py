@@ -0,0 +1,87 @@
+import csv
+import hashlib
+import logging
+import os
+import threading
+
+import numpy as np
+
+from .assortment_cache import save_atomic
+
+
+class ProductCatalog:
+    """Product names of the Grocery UPC database, indexed on first use.
+
+    Names are kept as one UTF-8 byte blob plus an offsets array, both memory-mapped
+    from `index_dir`, so sampling k names reads O(k) bytes and never builds a
+    DataFrame. The index is rebuilt whenever the CSV changes.
+    """
+
+    def __init__(self, path, index_dir=None):
+        self.path = path
+        self.index_dir = index_dir
+        self._blob = None
+        self._offsets = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        self._load()
+        return len(self._offsets) - 1
+
+    def sample(self, size, seed=None):
+        if not os.path.exists(self.path) and self._offsets is None:
+            logging.warning("Product database %s not found, using generic names",
+                            self.path)
+            return ['Item {}'.format(i) for i in range(size)]
+        rng = np.random.default_rng(seed)
+        count = len(self)
+        return [self[i] for i in rng.choice(count, size, replace=size > count)]
+
+    def __getitem__(self, i):
+        return bytes(self._blob[self._offsets[i]:self._offsets[i + 1]]).decode('utf-8')
+
+    def _load(self):
+        with self._lock:
+            if self._offsets is not None:
+                return
+            stat = os.stat(self.path)
+            key = '{}:{}:{}'.format(os.path.abspath(self.path), stat.st_size,
+                                    stat.st_mtime_ns)
+            prefix = os.path.join(self.index_dir or '',
+                                  hashlib.sha1(key.encode()).hexdigest())
+            try:
+                self._blob = np.load(prefix + '.names.npy', mmap_mode='r')
+                self._offsets = np.load(prefix + '.offsets.npy', mmap_mode='r')
+            except (OSError, ValueError):
+                (blob, offsets) = self._build()
+                if self.index_dir is not None:
+                    try:
+                        save_atomic(prefix + '.names.npy', blob)
+                        save_atomic(prefix + '.offsets.npy', offsets)
+                    except OSError as e:
+                        logging.warning("Could not write product index to %s: %s",
+                                        self.index_dir, e)
+                (self._blob, self._offsets) = (blob, offsets)
+
+    def _build(self):
+        # Stream the CSV once, keeping only the name column
+        names = []
+        with open(self.path, newline='', encoding='utf-8', errors='replace') as f:
+            reader = csv.reader(f)
+            header = next(reader)
+            column = header.index('name') if 'name' in header else len(header) - 1
+            for row in reader:
+                if len(row) > column:
+                    names.append(row[column].encode('utf-8'))
+        offsets = np.zeros(len(names) + 1, dtype=np.int64)
+        np.cumsum([len(name) for name in names], out=offsets[1:])
+        blob = np.frombuffer(b''.join(names), dtype=np.uint8)
+        return (blob, offsets)
+
+
+product_catalog = ProductCatalog(
+    os.getenv('RETAIL_UPC_DATABASE', 'Grocery_UPC_Database.csv'),
+    index_dir=os.getenv('RETAIL_CATALOG_DIR',
+                        os.path.join(os.path.expanduser('~'), '.cache', 'retail',
+                                     'catalog')) or None,
+)
@@ -0,0 +1,53 @@
+import os
+
+import numpy as np
+
+
+MODEL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'copulaModel.npz')
+
+
+class ClaytonCopula:
+    """In-process sampler for the fitted assortment copula.
+
+    Loads the Clayton copula parameter and the tabulated margin quantiles exported
+    from copulaModel.RData by util.Rexport, and samples them in one vectorized pass.
+    """
+
+    def __init__(self, path=MODEL_PATH):
+        with np.load(path) as model:
+            if str(model['family']) != 'claytonCopula':
+                raise ValueError("Unsupported copula family '{}'".format(model['family']))
+            self.theta = float(model['theta'])
+            self.columns = [str(c) for c in model['columns']]
+            self._logits = model['logits']
+            self._quantiles = model['quantiles']
+
+    def sample(self, size, seed=None):
+        rng = np.random.default_rng(seed)
+
+        # Marshall-Olkin: a shared gamma frailty couples independent exponentials
+
+        frailty = rng.standard_gamma(1 / self.theta, size=(size, 1))
+        uniforms = (1 + rng.standard_exponential((size, len(self.columns)))
+                    / frailty) ** (-1 / self.theta)
+        logits = np.log(uniforms) - np.log1p(-uniforms)
+        items = np.stack([np.interp(logits[:, i], self._logits, quantiles)
+                          for (i, quantiles) in enumerate(self._quantiles)], 1)
+
+        # Round shelf life to obtain at least 1 for every item
+
+        shelf_life = self.columns.index('Shelf_life')
+        items[:, shelf_life] = np.ceil(items[:, shelf_life])
+        return items
+
+
+def ks_statistics(sample, reference):
+    """Two-sample Kolmogorov-Smirnov statistic of each column, e.g. against the R backend"""
+    statistics = []
+    for (x, y) in zip(np.asarray(sample).T, np.asarray(reference).T):
+        grid = np.concatenate((x, y))
+        cdf_x = np.searchsorted(np.sort(x), grid, side='right') / len(x)
+        cdf_y = np.searchsorted(np.sort(y), grid, side='right') / len(y)
+        statistics.append(np.abs(cdf_x - cdf_y).max())
+    return np.array(statistics)
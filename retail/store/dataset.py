@@ -0,0 +1,230 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import tempfile
+
+import numpy as np
+import torch
+
+from .assortment_cache import save_atomic
+
+
+MANIFEST = 'manifest.json'
+
+# Fields of EnvInfo written with every step
+INFO_FIELDS = ('reward', 'sales', 'waste', 'availability')
+# Stored dtypes, float32 for other fields
+DTYPES = {'done': np.bool_}
+
+
+class TrajectoryWriter:
+    """Steps of StoreEnv episodes appended to a directory of .npy shards.
+
+    Every field is a column of (steps, *batch, items) arrays, (steps, *batch) for
+    done and (steps, *batch, items, features) for observations, cut into shards of about shard_bytes each and listed in a manifest.
+    Steps are copied into preallocated shard buffers, and full shards written by
+    a background thread while the next one fills, so that exports keep up with
+    steps. The manifest is only updated once the files of a shard are complete,
+    readers never see partial shards, and a writer opened on an existing
+    dataset appends to it. Observations are optional, see observe, and can be
+    those of observation_mode='compact' to keep datasets small.
+
+        with TrajectoryWriter('data') as sink:
+            rollout(env, policy, observe=True, sink=sink)
+    """
+
+    def __init__(self, directory, shard_bytes=64 * 2 ** 20):
+        self.directory = directory
+        self.shard_bytes = shard_bytes
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, MANIFEST)
+        if os.path.exists(path):
+            with open(path) as f:
+                self._manifest = json.load(f)
+        else:
+            self._manifest = {'fields': None, 'shards': []}
+        self._buffers = None
+        self._spare = None
+        self._length = 0
+        self._obs = None
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = None
+
+    def observe(self, obs):
+        """Records the observation the action of the next step is taken on"""
+        # A copy, as steps update observations in place
+        self._obs = np.array(obs, dtype=np.float32)
+
+    def record(self, action, reward, info):
+        """Appends a step, with the observation given to observe if any"""
+        row = {'order': np.asarray(action), 'done': np.asarray(info.traj_done)}
+        for field in INFO_FIELDS:
+            row[field] = np.asarray(getattr(info, field))
+        if self._obs is not None:
+            row['obs'] = self._obs
+            self._obs = None
+        if self._buffers is None:
+            self._allocate(row)
+        elif row.keys() != self._buffers.keys():
+            raise ValueError('Steps of a dataset must all have the same fields, got {}'.format(
+                sorted(row)))
+        t = self._length
+        for (field, value) in row.items():
+            self._buffers[field][t] = value
+        self._length += 1
+        if self._length == len(self._buffers['order']):
+            self.flush()
+
+    def flush(self):
+        """Writes the steps recorded so far as a shard, in the background"""
+        if not self._length:
+            return
+        self.wait()
+        (buffers, length) = (self._buffers, self._length)
+        self._pending = self._executor.submit(self._writeShard, buffers, length)
+        # Buffers alternate between the one filling and the one being written
+        (self._buffers, self._spare, self._length) = (self._spare, buffers, 0)
+        if self._buffers is None:
+            self._buffers = {field: np.empty_like(values) for (field, values) in buffers.items()}
+
+    def wait(self):
+        # Waits for the shard being written, raising its errors
+        if self._pending is not None:
+            (pending, self._pending) = (self._pending, None)
+            pending.result()
+
+    def close(self):
+        self.flush()
+        self.wait()
+        self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # ##########################################################################
+    # Helpers
+
+    def _allocate(self, row):
+        # Waste is 0 before the end of the day, and done a single flag
+        shape = list(row['sales'].shape)
+        shapes = {field: shape for field in row}
+        shapes.update(done=shape[:-1])
+        if 'obs' in row:
+            shapes['obs'] = list(row['obs'].shape)
+        fields = {field: {'shape': shapes[field],
+                          'dtype': np.dtype(DTYPES.get(field, np.float32)).str}
+                  for field in sorted(row)}
+        if self._manifest['fields'] is None:
+            self._manifest['fields'] = fields
+        elif self._manifest['fields'] != fields:
+            raise ValueError('Steps do not match the fields of the dataset in {}'.format(
+                self.directory))
+        step_bytes = sum(np.dtype(spec['dtype']).itemsize * int(np.prod(spec['shape']))
+                         for spec in fields.values())
+        steps = max(1, self.shard_bytes // step_bytes)
+        self._buffers = {field: np.empty([steps] + spec['shape'], dtype=spec['dtype'])
+                         for (field, spec) in fields.items()}
+
+    def _writeShard(self, buffers, length):
+        shard = len(self._manifest['shards'])
+        for (field, values) in buffers.items():
+            save_atomic(os.path.join(self.directory, _shardFile(shard, field)),
+                        values[:length])
+        self._manifest['shards'].append({'steps': length})
+        _dumpAtomic(os.path.join(self.directory, MANIFEST), self._manifest)
+
+
+class TrajectoryDataset:
+    """Steps written by a TrajectoryWriter, memory-mapped rather than loaded.
+
+    Shards are mapped on first access, and minibatches only read the rows of
+    the steps they gather, so datasets need not fit in memory. Fields are
+    returned as tensors with a leading dimension of steps. Only the shards in
+    the manifest when the dataset is opened are seen.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, MANIFEST)) as f:
+            manifest = json.load(f)
+        self.fields = manifest['fields'] or {}
+        self._ends = np.cumsum([shard['steps'] for shard in manifest['shards']], dtype=np.int64)
+        self._shards = {}
+        self._continued = None
+
+    def __len__(self):
+        return int(self._ends[-1]) if len(self._ends) else 0
+
+    def get(self, indices, fields=None):
+        """Fields of the steps at indices, in their order"""
+        indices = np.asarray(indices, dtype=np.int64)
+        if indices.size and (indices.min() < 0 or indices.max() >= len(self)):
+            raise IndexError('Step indices out of range of {} steps'.format(len(self)))
+        shards = np.searchsorted(self._ends, indices, side='right')
+        starts = np.concatenate([[0], self._ends])[shards]
+        batch = {}
+        for field in fields or self.fields:
+            spec = self.fields[field]
+            values = np.empty([len(indices)] + spec['shape'], dtype=spec['dtype'])
+            for shard in np.unique(shards):
+                rows = shards == shard
+                values[rows] = self._shard(shard, field)[indices[rows] - starts[rows]]
+            batch[field] = torch.from_numpy(values)
+        return batch
+
+    def sample(self, batch_size, fields=None, transitions=False, generator=None):
+        """Fields of batch_size steps drawn uniformly with replacement.
+
+        With transitions, steps are drawn among those followed by a step of
+        the same episode, whose observation is added as next_obs.
+        """
+        if transitions and 'obs' not in self.fields:
+            raise ValueError('Transitions need recorded observations, which the dataset in {} '
+                             'lacks, see rollout(..., observe=True)'.format(self.directory))
+        if transitions:
+            candidates = self._continuedSteps()
+            draws = torch.randint(len(candidates), (batch_size, ), generator=generator)
+            indices = candidates[draws.numpy()]
+        else:
+            indices = torch.randint(len(self), (batch_size, ), generator=generator).numpy()
+        batch = self.get(indices, fields)
+        if transitions:
+            batch['next_obs'] = self.get(indices + 1, ['obs'])['obs']
+        return batch
+
+    # ##########################################################################
+    # Helpers
+
+    def _shard(self, shard, field):
+        key = (int(shard), field)
+        if key not in self._shards:
+            self._shards[key] = np.load(os.path.join(self.directory, _shardFile(*key)),
+                                        mmap_mode='r')
+        return self._shards[key]
+
+    def _continuedSteps(self):
+        # Steps not ending an episode nor the dataset
+        if self._continued is None:
+            done = self.get(np.arange(len(self)), ['done'])['done'].numpy()
+            done = done.reshape(len(done), -1).any(-1)
+            done[-1:] = True
+            self._continued = np.flatnonzero(~done)
+        return self._continued
+
+
+def _shardFile(shard, field):
+    return '{:05d}.{}.npy'.format(shard, field)
+
+
+def _dumpAtomic(path, data):
+    (fd, tmp_path) = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
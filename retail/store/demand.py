@@ -0,0 +1,46 @@
+import torch
+import torch.distributions as d
+
+
+class BernoulliDemand:
+    """One purchase draw per customer and item, summed over customers.
+
+    Allocates a (customers x items) tensor on every call, kept as the reference model.
+    """
+
+    def sample(self, customers, probs):
+        if customers.numel() != 1:
+            raise ValueError('BernoulliDemand draws for a single store at a time')
+        purchases_gen = d.bernoulli.Bernoulli(probs)
+        return purchases_gen.sample((int(customers), )).sum(0)
+
+
+class BinomialDemand:
+    """Same distribution as BernoulliDemand, drawn directly as per-item totals."""
+
+    def sample(self, customers, probs):
+        return d.binomial.Binomial(customers, probs).sample()
+
+
+class PoissonDemand:
+    """Per-item demand with mean customers * probs, for high-traffic stores."""
+
+    def sample(self, customers, probs):
+        return torch.poisson(customers * probs)
+
+
+class NegativeBinomialDemand:
+    """Overdispersed per-item demand with mean customers * probs.
+
+    The variance is mean + mean ** 2 / dispersion, Poisson being the limit of a large dispersion.
+    """
+
+    def __init__(self, dispersion=1.):
+        self.dispersion = dispersion
+
+    def sample(self, customers, probs):
+        mean = customers * probs
+        demand_gen = \
+            d.negative_binomial.NegativeBinomial(self.dispersion,
+                                                 probs=mean / (mean + self.dispersion))
+        return demand_gen.sample()
@@ -0,0 +1,157 @@
+from bisect import insort
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import functools
+import math
+
+import numpy as np
+import torch
+import torch.distributions as d
+
+from retail.expression import ORDER_VARIABLES, compile_expression
+
+from .rollout import expression_policy, rollout
+from .store_env import StoreEnv
+
+
+class RiskEstimator:
+    """Online estimates of the lower tail of a reward distribution.
+
+    VaR is the alpha-quantile of the values and CVaR the mean of the values below
+    it, as computed in the CVaR notebook. The VaR interval comes from the order
+    statistics of a binomial count, the CVaR one from the standard error of
+    VaR + min(x - VaR, 0) / alpha.
+    """
+
+    def __init__(self, alpha=0.05, confidence=0.95):
+        self.alpha = alpha
+        self.confidence = confidence
+        self.values = []
+        self._sorted = []
+        self._z = float(d.Normal(0., 1.).icdf(torch.tensor(0.5 + confidence / 2)))
+
+    def update(self, value):
+        self.values.append(value)
+        insort(self._sorted, value)
+
+    @property
+    def n(self):
+        return len(self.values)
+
+    @property
+    def mean(self):
+        return float(np.mean(self.values))
+
+    def quantile(self, q):
+        return float(np.quantile(self._sorted, q))
+
+    @property
+    def var(self):
+        return self.quantile(self.alpha)
+
+    @property
+    def cvar(self):
+        var = self.var
+        tail = [x for x in self._sorted if x < var]
+        return float(np.mean(tail)) if tail else var
+
+    @property
+    def cvar_stderr(self):
+        if self.n < 2:
+            return math.inf
+        var = self.var
+        losses = var + np.minimum(np.asarray(self._sorted) - var, 0) / self.alpha
+        return float(losses.std(ddof=1) / math.sqrt(self.n))
+
+    @property
+    def var_interval(self):
+        spread = self._z * math.sqrt(self.n * self.alpha * (1 - self.alpha))
+        low = max(0, int(math.floor(self.n * self.alpha - spread)))
+        high = min(self.n - 1, int(math.ceil(self.n * self.alpha + spread)))
+        return (self._sorted[low], self._sorted[high])
+
+    @property
+    def cvar_interval(self):
+        (cvar, width) = (self.cvar, self._z * self.cvar_stderr)
+        return (cvar - width, cvar + width)
+
+    def summary(self):
+        return {'n': self.n, 'mean': self.mean, 'var': self.var,
+                'cvar': self.cvar, 'var_interval': self.var_interval,
+                'cvar_interval': self.cvar_interval}
+
+
+def mean_reward(trajectory):
+    return float(trajectory.reward.mean())
+
+
+def evaluate(store_kwargs, policy, replications, **kwargs):
+    """RiskEstimator over all replications, see evaluate_iter"""
+    estimator = None
+    for estimator in evaluate_iter(store_kwargs, policy, replications, **kwargs):
+        pass
+    return estimator
+
+
+def evaluate_iter(store_kwargs, policy, replications, alpha=0.05,
+                  confidence=0.95, seed=0, processes=None, precision=None,
+                  min_replications=30, statistic=mean_reward):
+    """Run Monte Carlo replications of a policy and yield the updated estimator.
+
+    Replication i seeds torch and numpy with seed + i, then builds a StoreEnv
+    from store_kwargs, or from store_kwargs(i) when it is callable, e.g. to
+    sample customer buckets. policy is an order expression or a picklable
+    callable(env), and statistic reduces each Trajectory to one value.
+    Replications run on `processes` workers (all cores by default, inline when
+    1) and are consumed in index order, so estimates only depend on the seed.
+    The run stops early once the CVaR interval half-width is below precision.
+    """
+    if isinstance(policy, str):
+        compile_expression(policy, ORDER_VARIABLES)
+    estimator = RiskEstimator(alpha, confidence)
+    job = functools.partial(_replicate, store_kwargs, policy, statistic, seed)
+    if processes == 1:
+        results = map(job, range(replications))
+        pool = None
+    else:
+        pool = ProcessPoolExecutor(processes, initializer=torch.set_num_threads,
+                                   initargs=(1, ))
+        results = _ordered(pool, job, replications)
+    try:
+        for value in results:
+            estimator.update(value)
+            yield estimator
+            if precision is not None and estimator.n >= min_replications \
+                    and estimator.cvar_stderr * estimator._z <= precision:
+                return
+    finally:
+        if pool is not None:
+            results.close()
+            pool.shutdown()
+
+
+def _ordered(pool, job, replications):
+    # Keeps every worker busy while yielding results in submission order
+    window = 2 * pool._max_workers
+    futures = deque(pool.submit(job, i) for i in range(min(window, replications)))
+    submitted = len(futures)
+    try:
+        while futures:
+            value = futures.popleft().result()
+            if submitted < replications:
+                futures.append(pool.submit(job, submitted))
+                submitted += 1
+            yield value
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+def _replicate(store_kwargs, policy, statistic, seed, i):
+    torch.manual_seed(seed + i)
+    np.random.seed(seed + i)
+    kwargs = store_kwargs(i) if callable(store_kwargs) else store_kwargs
+    env = StoreEnv(**kwargs)
+    if isinstance(policy, str):
+        policy = expression_policy(policy, env.bucket_customers.sum())
+    return statistic(rollout(env, policy))
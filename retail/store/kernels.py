@@ -0,0 +1,258 @@
+import functools
+import logging
+from typing import Optional, Tuple
+
+import torch
+from torch import Tensor
+import torch.nn.functional as F
+
+from retail.utility import CobbDouglasUtility, HomogeneousReward, LinearUtility, LogLinearUtility
+
+from .demand import BinomialDemand, PoissonDemand
+from .stock import (DenseStock, HistogramStock, histogram_add, histogram_age,
+                    histogram_count, histogram_expiring, histogram_remove)
+
+
+# Models implemented by StepKernel, by exact type
+_DEMANDS = {BinomialDemand: 0, PoissonDemand: 1}
+_UTILITIES = {LinearUtility: 0, CobbDouglasUtility: 1, LogLinearUtility: 2,
+              HomogeneousReward: 3}
+_STOCKS = (DenseStock, HistogramStock)
+
+# torch.compile of StepKernel.update shared by all kernels, see compile_step
+_compiled_update = None
+
+
+class StepKernel(torch.nn.Module):
+    """One StoreEnv step in a single function, for TorchScript or torch.compile.
+
+    The order arrival, restock, customer and demand draws, sale, waste, aging
+    and reward of StoreEnv.step, with the same operations in the same order, so
+    that under a fixed seed the results are those of the eager step. Pipeline
+    slots and histogram counts are updated in place, the new stock is returned.
+    Observations, forecasts and shipping costs stay in StoreEnv. Covers the
+    dense and histogram stocks, binomial and Poisson demand, and the built-in
+    utilities, and any demand model with random streams, see supports.
+    """
+
+    def __init__(self, env):
+        super().__init__()
+        stock = env._stock
+        self.histogram = isinstance(stock, HistogramStock)
+        if self.histogram:
+            self.stocked = stock._stocked
+            self.double = stock._double
+            set_layout(self, stock)
+        else:
+            (self.lives, self.starts, self.lasts, self.stocked, self.items) = \
+                (stock.shelf_lives, ) + (torch.empty(0, dtype=torch.long), ) * 4
+            self.double = False
+            self.span = 0
+        # Also gives max_stock, as a size that torch.compile keeps dynamic
+        # rather than an int it would compile again for every value
+        self.slots = torch.arange(env._max_stock)
+        self.price = env.assortment.selling_price
+        self.margin = env.assortment.selling_price - env.assortment.cost
+        # Customers as drawn by MultivariateNormal.sample
+        shared_dims = len(env._batch_shape) - len(env._customers.batch_shape)
+        self.customer_shape = list(env._batch_shape[:shared_dims]
+                                   + env._customers.batch_shape
+                                   + env._customers.event_shape)
+        self.loc = env._customers.loc
+        self.scale_tril = env._customers._unbroadcasted_scale_tril
+        # Unused when demand comes from random streams
+        self.demand_model = _DEMANDS.get(type(env._demand), -1)
+        self.utility = _UTILITIES[type(env.utility_function)]
+        self.alpha = float(env.utility_function._alpha)
+        self.beta = float(env.utility_function._beta)
+        self.gamma = float(env.utility_function._gamma)
+        # Whether to merge overflows without testing for them, as graphs
+        # compiled by torch.compile would break on the test
+        self.branchless = False
+
+    @staticmethod
+    def supports(env):
+        return (type(env._stock) in _STOCKS and type(env.utility_function) in _UTILITIES
+                and (type(env._demand) in _DEMANDS or env._streams is not None))
+
+    def forward(self, stock: Tensor, slots: Tensor, in_transit: Tensor, due: Tensor,
+                head: Tensor, units: Tensor, shipping: Optional[Tensor], real: Tensor,
+                day: Tensor, demand: Optional[Tensor],
+                end_of_day: bool) -> Tuple[Tensor, Tensor, Tensor, Tensor, Tensor]:
+        """(stock, sales, availability, waste, utility) of a step ordering units.
+
+        slots and in_transit are those of the pipeline the order goes through,
+        updated in place, due and head the one-element indices of the slot of
+        the order and of the arrivals. day is the one-element index of the
+        customer bucket. demand is drawn here unless given, as by
+        streams.RandomStreams, and waste is zero before the end of the day.
+        """
+        (stock, sales, availability, waste) = self.update(
+            stock, slots, in_transit, due, head, units, shipping, real, day, demand,
+            end_of_day)
+        return (stock, sales, availability, waste, self._reward(sales, waste, availability))
+
+    def update(self, stock: Tensor, slots: Tensor, in_transit: Tensor, due: Tensor,
+               head: Tensor, units: Tensor, shipping: Optional[Tensor], real: Tensor,
+               day: Tensor, demand: Optional[Tensor],
+               end_of_day: bool) -> Tuple[Tensor, Tensor, Tensor, Tensor]:
+        # Everything but the reward, see forward
+
+        # OrderPipeline.push, indexing slots with tensors rather than ints, of
+        # which torch.compile would specialize every value
+        units = units.float()
+        slots.index_add_(0, due, units.unsqueeze(0))
+        in_transit.add_(units)
+        arrivals = slots.index_select(0, head).squeeze(0)
+        slots.index_fill_(0, head, 0.)
+        in_transit.sub_(arrivals)
+
+        # StoreEnv._addStock
+        if self.histogram:
+            (stock, overflow) = self._histogramAdd(stock, arrivals)
+        else:
+            (stock, overflow) = self._denseAdd(stock, arrivals)
+        order_cost = overflow.mul_(self.price)
+        if shipping is not None:
+            order_cost += shipping
+
+        # StoreEnv._generateDemand
+        probs = real.clamp_(0.0, 1.)
+        if demand is None:
+            units = self._drawDemand(probs, day)
+        else:
+            units = demand
+
+        # StoreEnv._sellUnits
+        on_hand = self._count(stock)
+        sold = torch.min(on_hand, units)
+        availability = on_hand.div(units).clamp(0, 1)
+        availability[torch.isnan(availability)] = 1.
+        sales = sold.mul_(2).sub_(units).mul(self.margin)
+        if self.histogram:
+            stock = self._histogramRemove(stock, units)
+        else:
+            stock = self._denseRemove(stock, units)
+
+        # StoreEnv._waste and _reduceShelfLives
+        if end_of_day:
+            if self.histogram:
+                waste = torch.mul(histogram_expiring(stock, self.starts, self.lasts), self.price)
+                stock = histogram_age(stock, self.starts)
+            else:
+                waste = torch.mul(stock.eq(1).sum(-1).float(), self.price)
+                stock = F.relu(stock - 1)
+        else:
+            waste = torch.zeros_like(sales)
+        sales -= order_cost
+        return (stock, sales, availability, waste)
+
+    def _drawDemand(self, probs: Tensor, day: Tensor) -> Tensor:
+        eps = torch.empty(self.customer_shape, dtype=self.loc.dtype).normal_()
+        customers = self.loc + torch.matmul(self.scale_tril, eps.unsqueeze(-1)).squeeze(-1)
+        customers = customers.round().index_select(-1, day).clamp(min=0)
+        if self.demand_model == 0:
+            (count, probs) = torch.broadcast_tensors(customers, probs)
+            demand = torch.binomial(count.to(probs.dtype), probs)
+        else:
+            demand = torch.poisson(customers * probs)
+        return demand.clamp(0, self.slots.size(0))
+
+    def _count(self, stock: Tensor) -> Tensor:
+        if self.histogram:
+            return histogram_count(stock, self.starts, self.lasts, self.double)
+        return stock.ge(1).sum(-1).float()
+
+    def _denseAdd(self, stock: Tensor, units: Tensor) -> Tuple[Tensor, Tensor]:
+        # New units fill the first slots of each row, the stock sorted ascending the last ones
+        restock = self.lives.unsqueeze(-1) * self.slots.lt(units.long().unsqueeze(-1)).float()
+        stock = stock.sort(-1)[0] + restock
+        total_units = restock.ge(1).sum(-1) + stock.ge(1).sum(-1)
+        return (stock, F.relu(total_units - self.slots.size(0)).float())
+
+    def _denseRemove(self, stock: Tensor, units: Tensor) -> Tensor:
+        # Sold units are the first slots of each row sorted descending
+        kept = self.slots.ge(units.long().unsqueeze(-1)).float()
+        return kept * stock.sort(-1, descending=True)[0]
+
+    def _histogramAdd(self, counts: Tensor, units: Tensor) -> Tuple[Tensor, Tensor]:
+        return histogram_add(counts, units, self.lives, self.starts, self.lasts, self.items,
+                             self.stocked, self.slots.size(0), self.double, self.branchless)
+
+    def _histogramRemove(self, counts: Tensor, units: Tensor) -> Tensor:
+        return histogram_remove(counts, units, self.lasts, self.items, self.double)
+
+    def _reward(self, sales: Tensor, waste: Tensor, availability: Tensor) -> Tensor:
+        # Same expressions as retail.utility
+        if self.utility == 0:
+            return sales * self.alpha - waste * self.beta + availability * self.gamma
+        elif self.utility == 1:
+            return torch.pow(F.relu(sales), self.alpha) * torch.pow(1 + waste, -self.beta) \
+                * torch.pow(availability, self.gamma)
+        elif self.utility == 2:
+            return torch.log(1 + F.relu(sales)) * self.alpha \
+                - torch.log(1. + waste) * self.beta + torch.log(1. + availability) * self.gamma
+        return (torch.pow(availability, self.gamma) * (sales - waste)).squeeze()
+
+
+def set_layout(kernel, stock):
+    """Points kernel at the buckets of a HistogramStock, as widened by its reserve"""
+    (kernel.lives, kernel.starts, kernel.lasts) = (stock._lives, stock._starts, stock._lasts)
+    # Kept rather than built on every step as by HistogramStock
+    kernel.items = stock._items()
+    kernel.span = stock._span
+
+
+def compile_step(env, mode):
+    """Compiled StepKernel of env, or None to step in eager mode.
+
+    mode is 'script' for TorchScript or 'compile' for torch.compile, which needs
+    torch 2. Falls back to eager mode, with a warning, for configurations the
+    kernel does not cover and when compilation fails. The kernel runs once on
+    copies of the state, so that compilation happens here rather than on the
+    first step.
+    """
+    if not StepKernel.supports(env):
+        logging.warning("No %s step kernel for this store configuration, stepping in eager mode", mode)
+        return None
+    try:
+        if mode == 'script':
+            kernel = torch.jit.script(StepKernel(env))
+        elif not hasattr(torch, 'compile'):
+            raise RuntimeError('torch.compile needs torch 2')
+        else:
+            # Rewards stay eager, as generated code rounds logarithms and
+            # powers differently, and random draws are those of eager mode
+            kernel = StepKernel(env)
+            kernel.branchless = True
+            kernel.update = functools.partial(_compiledUpdate(), kernel)
+        _warmUp(env, kernel)
+    except Exception as e:
+        logging.warning("Compiling the %s step kernel failed, stepping in eager mode: %s", mode, e)
+        return None
+    return kernel
+
+
+def _compiledUpdate():
+    # One compiled function with dynamic sizes, rather than one per store, of
+    # which dynamo would only compile the first recompile_limit
+    global _compiled_update
+    if _compiled_update is None:
+        _compiled_update = torch.compile(StepKernel.update, dynamic=True,
+                                         options={'fallback_random': True})
+    return _compiled_update
+
+
+def _warmUp(env, kernel):
+    # Both kinds of steps, leaving the env and the global RNG untouched
+    stock = next(iter(env._stock.state_dict().values()))
+    shipping = None
+    if env.transportation is not None:
+        shipping = torch.zeros(env._batch_shape + (env._assortment_size, ))
+    units = torch.zeros(env._batch_shape + (env._assortment_size, ), dtype=torch.int32)
+    with torch.random.fork_rng(devices=[]), torch.no_grad():
+        for (buffer, end_of_day) in ((env._buffer, False), (env._buffer_fast, True)):
+            (due, head) = env._slotIndices(buffer)
+            kernel(stock.clone(), buffer._slots.clone(), buffer.in_transit.clone(), due, head,
+                   units, shipping, env.real.clone(), env._indices[0], env._streamDemand(),
+                   end_of_day)
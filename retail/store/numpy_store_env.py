@@ -0,0 +1,123 @@
+import numpy as np
+import torch
+
+from rlpyt.envs.base import EnvStep
+
+from .pipeline import NumpyOrderPipeline
+from .stock import NumpyDenseStock, NumpyHistogramStock
+from .store_env import EnvInfo, StoreEnv
+
+
+class NumpyStoreEnv(StoreEnv):
+    """StoreEnv stepping on NumPy arrays, for small interactive simulations.
+
+    With a few dozen items, a torch step mostly pays the dispatch overhead of its
+    many small ops. Here stock, order buffers and observations are NumPy arrays,
+    while customers, demand and forecast noise are still drawn by torch from the
+    same distributions, so that under a fixed seed rewards, sales and
+    observations are identical to those of StoreEnv. Steps, positions and stock
+    are returned as tensors sharing memory with the arrays. Stores are single,
+    see BatchedStoreEnv for batched training.
+    """
+
+    def step(self, action):
+        (obs, utility, done, info) = super().step(action)
+        info = EnvInfo(*(torch.from_numpy(value) if isinstance(value, np.ndarray) else value
+                         for value in info))
+        return EnvStep(obs, torch.as_tensor(utility), done, info)
+
+    def get_partial_position(self):
+        return torch.from_numpy(self._stock.count())
+
+    def get_full_inventory_position(self):
+        return torch.from_numpy(self._stock.count() + self._buffer.in_transit)
+
+    def create_buffers(self, slow_speed, fast_speed):
+        self._buffer = NumpyOrderPipeline(slow_speed, self._assortment_size)
+        self._buffer_fast = NumpyOrderPipeline(fast_speed, self._assortment_size)
+
+    # ##########################################################################
+    # Helpers
+
+    def _action(self, action):
+        action = np.asarray(action)
+        if self._symmetric_action_space:
+            return (np.clip(np.round(action), 0, self._max_stock)
+                    + self._max_stock / 2).astype(np.int32)
+        return np.clip(action.astype(np.int32), 0, self._max_stock)
+
+    def _allocateObs(self):
+        super()._allocateObs()
+        (self._np_obs_stock, self._np_obs_forecast, self._np_obs_transit,
+         self._np_obs_transit_fast, self._np_obs_day) = (
+            self._obs_stock.numpy(), self._obs_forecast.numpy(),
+            self._obs_transit.numpy(), self._obs_transit_fast.numpy(),
+            self._obs_day.numpy())
+
+    def _updateObs(self):
+        if not self._observe:
+            return
+        if self._observation_mode == 'full':
+            self._np_obs_stock[...] = self._stock.matrix()
+        else:
+            self._np_obs_stock[...] = self._stock.age_profile(self._age_bins)
+        self._np_obs_forecast[...] = self.forecast.numpy()
+        self._buffer.pending(out=self._np_obs_transit)
+        self._buffer_fast.pending(out=self._np_obs_transit_fast)
+        self._np_obs_day.fill(self.day_position)
+
+    def _createStock(self, stock_engine):
+        shelf_lives = self.assortment.shelf_lives.numpy()
+        if stock_engine == 'dense':
+            return NumpyDenseStock(shelf_lives, self._max_stock)
+        elif stock_engine == 'histogram':
+            return NumpyHistogramStock(shelf_lives, self._max_stock)
+        else:
+            return stock_engine(shelf_lives, self._max_stock)
+
+    def _addStock(self, units):
+        # Initial orders come as tensors, see StoreEnv.__init__
+        penalty_cost_forbidden = self._stock.add(np.asarray(units))
+        np.multiply(penalty_cost_forbidden, self.assortment.selling_price.numpy(),
+                    out=penalty_cost_forbidden, casting='same_kind')
+        return penalty_cost_forbidden
+
+    def _sellUnits(self, units):
+        # Demand is drawn by torch, see StoreEnv._generateDemand
+        units = units.numpy()
+        on_hand = self._stock.count()
+        sold = np.minimum(on_hand, units)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            availability = np.clip(on_hand / units, 0, 1)
+        availability[np.isnan(availability)] = 1.
+        reward = (sold * 2 - units) * (self.assortment.selling_price.numpy()
+                                       - self.assortment.cost.numpy())
+        self._stock.remove(units)
+        return (reward, availability)
+
+    def _waste(self):
+        return self._stock.expiring() * self.assortment.selling_price.numpy()
+
+    def _shippingCost(self, units, lead_time):
+        return super()._shippingCost(torch.from_numpy(units), lead_time).numpy()
+
+    # ##########################################################################
+    # Properties
+
+    @property
+    def stock(self):
+        return torch.from_numpy(self._stock.matrix())
+
+
+def set_num_threads(threads):
+    """Caps the intra-op threads of torch and, with threadpoolctl, of the BLAS used by NumPy.
+
+    Small simulations gain nothing from thread pools, which only contend with
+    each other when several app workers share a machine.
+    """
+    torch.set_num_threads(threads)
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return
+    threadpool_limits(threads)
@@ -0,0 +1,112 @@
+import numpy as np
+import torch
+
+
+class OrderPipeline:
+    """Orders in transit, stored in a preallocated ring of arrivals indexed by due step.
+
+    Slot (head + k) of the ring holds the units arriving in k + 1 pushes, and the
+    total in transit is kept up to date, so that pushing an order and reading the
+    inventory position cost O(items). push accepts a per-item (or per-order random)
+    lead time up to `lead_time`, which is the pipeline depth.
+    """
+
+    def __init__(self, lead_time, size, batch_shape=()):
+        self.lead_time = lead_time
+        self._slots = torch.zeros((lead_time + 1, ) + tuple(batch_shape) + (size, ))
+        self._head = 0
+        self.in_transit = torch.zeros(tuple(batch_shape) + (size, ))
+
+    def push(self, units, lead_time=None):
+        """Order units and return the units arriving at this step"""
+        units = units.float()
+        depth = self.lead_time + 1
+        if lead_time is None:
+            self._slots[(self._head + self.lead_time) % depth].add_(units)
+        else:
+            lead_time = torch.as_tensor(lead_time).long()
+            _checkLeadTime(int(lead_time.min()), int(lead_time.max()), self.lead_time)
+            due = (self._head + lead_time) % depth
+            self._slots.scatter_add_(0, due.expand_as(units).unsqueeze(0),
+                                     units.unsqueeze(0))
+        self.in_transit.add_(units)
+        arrivals = self._slots[self._head].clone()
+        self._slots[self._head].zero_()
+        self.in_transit.sub_(arrivals)
+        self._head = (self._head + 1) % depth
+        return arrivals
+
+    def pending(self, out=None):
+        """(lead_time, *batch, items) units in transit, next arrivals first"""
+        (first, second) = (self._slots[self._head:self._head + self.lead_time],
+                           self._slots[:max(0, self._head - 1)])
+        if out is None:
+            return torch.cat((first, second))
+        out[:len(first)].copy_(first)
+        out[len(first):].copy_(second)
+        return out
+
+    def state_dict(self):
+        return {'slots': self._slots, 'head': self._head,
+                'in_transit': self.in_transit}
+
+    def load_state_dict(self, state):
+        self._slots = state['slots']
+        self._head = state['head']
+        self.in_transit = state['in_transit']
+
+
+class NumpyOrderPipeline:
+    """OrderPipeline on a float32 NumPy ring, giving the same results, see NumpyStoreEnv."""
+
+    def __init__(self, lead_time, size, batch_shape=()):
+        self.lead_time = lead_time
+        self._slots = np.zeros((lead_time + 1, ) + tuple(batch_shape) + (size, ),
+                               dtype=np.float32)
+        self._head = 0
+        self.in_transit = np.zeros(tuple(batch_shape) + (size, ), dtype=np.float32)
+
+    def push(self, units, lead_time=None):
+        """Order units and return the units arriving at this step"""
+        units = np.asarray(units, dtype=np.float32)
+        depth = self.lead_time + 1
+        if lead_time is None:
+            self._slots[(self._head + self.lead_time) % depth] += units
+        else:
+            lead_time = np.asarray(lead_time, dtype=np.int64)
+            _checkLeadTime(lead_time.min(), lead_time.max(), self.lead_time)
+            due = (self._head + lead_time) % depth
+            np.add.at(self._slots, (np.broadcast_to(due, units.shape), )
+                      + tuple(np.indices(units.shape)), units)
+        self.in_transit += units
+        arrivals = self._slots[self._head].copy()
+        self._slots[self._head] = 0.
+        self.in_transit -= arrivals
+        self._head = (self._head + 1) % depth
+        return arrivals
+
+    def pending(self, out=None):
+        """(lead_time, *batch, items) units in transit, next arrivals first"""
+        (first, second) = (self._slots[self._head:self._head + self.lead_time],
+                           self._slots[:max(0, self._head - 1)])
+        if out is None:
+            return np.concatenate((first, second))
+        out[:len(first)] = first
+        out[len(first):] = second
+        return out
+
+    def state_dict(self):
+        return {'slots': torch.from_numpy(self._slots), 'head': self._head,
+                'in_transit': torch.from_numpy(self.in_transit)}
+
+    def load_state_dict(self, state):
+        self._slots = torch.as_tensor(state['slots']).numpy()
+        self._head = state['head']
+        self.in_transit = torch.as_tensor(state['in_transit']).numpy()
+
+
+def _checkLeadTime(shortest, longest, depth):
+    # Beyond the ring, orders would wrap around and arrive early
+    if shortest < 0 or longest > depth:
+        raise ValueError('Lead times must be between 0 and {}, got {} to {}'.format(
+            depth, shortest, longest))
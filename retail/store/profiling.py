@@ -0,0 +1,146 @@
+import bisect
+import contextlib
+import inspect
+import json
+import math
+import os
+import threading
+import time
+
+import torch
+
+
+# Hot-path methods timed by default, nested ones count in their callers too
+PHASES = ('step', '_kernelStep', '_make_order', '_make_fast_order', '_shippingCost', '_addStock',
+          '_generateDemand', '_sellUnits', '_waste', '_reduceShelfLives',
+          '_updateEnv', '_updateObs')
+
+# Histogram bucket upper bounds in seconds, four per octave from 1us to ~70s
+BUCKETS = tuple(1e-6 * 2 ** (i / 4) for i in range(105))
+
+
+class StepProfiler:
+    """Opt-in per-phase timing of a StoreEnv.
+
+    Timing wraps the phase methods of one env instance while the profiler is
+    started, and removes the wrappers when it stops, so that an env that is not
+    profiled runs the plain methods. Every phase gets a call count, total time
+    and a histogram of call durations, from which percentiles are estimated.
+    With memory, bytes allocated per phase are measured with the torch
+    profiler, where it supports it. With trace, every call is kept for
+    export_chrome_trace.
+    """
+
+    def __init__(self, env, phases=PHASES, memory=False, trace=False):
+        self.env = env
+        self.phases = tuple(phases)
+        self.memory = memory
+        self.trace = trace
+        self.reset()
+        self._torch_profiler = None
+
+    def reset(self):
+        self._counts = {phase: [0] * (len(BUCKETS) + 1) for phase in self.phases}
+        self._totals = dict.fromkeys(self.phases, 0.)
+        self._maxima = dict.fromkeys(self.phases, 0.)
+        self._bytes = {}
+        self._events = []
+
+    def start(self):
+        if self.memory and 'profile_memory' in inspect.signature(
+                torch.autograd.profiler.profile).parameters:
+            self._torch_profiler = torch.autograd.profiler.profile(profile_memory=True)
+            self._torch_profiler.__enter__()
+        for phase in self.phases:
+            setattr(self.env, phase, self._wrap(phase, getattr(self.env, phase)))
+        return self
+
+    def stop(self):
+        for phase in self.phases:
+            self.env.__dict__.pop(phase, None)
+        if self._torch_profiler is not None:
+            self._torch_profiler.__exit__(None, None, None)
+            for event in self._torch_profiler.key_averages():
+                if event.key in self._totals:
+                    self._bytes[event.key] = self._bytes.get(event.key, 0) \
+                        + event.cpu_memory_usage
+            self._torch_profiler = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _wrap(self, phase, method):
+        counts = self._counts[phase]
+        labelled = self._torch_profiler is not None
+        thread = threading.get_ident()
+
+        def timed(*args, **kwargs):
+            with torch.autograd.profiler.record_function(phase) if labelled \
+                    else contextlib.suppress():
+                start = time.perf_counter()
+                try:
+                    return method(*args, **kwargs)
+                finally:
+                    duration = time.perf_counter() - start
+                    counts[bisect.bisect_left(BUCKETS, duration)] += 1
+                    self._totals[phase] += duration
+                    self._maxima[phase] = max(self._maxima[phase], duration)
+                    if self.trace:
+                        self._events.append((phase, start, duration, thread))
+        # Marks the wrapper, which copies of the env such as StoreEnv.fork leave out
+        timed.profiled = True
+        return timed
+
+    def stats(self):
+        """{phase: {count, total, mean, max, p50, p90, p99, bytes}}, times in seconds"""
+        stats = {}
+        for phase in self.phases:
+            count = sum(self._counts[phase])
+            if count == 0:
+                continue
+            stats[phase] = {
+                'count': count,
+                'total': self._totals[phase],
+                'mean': self._totals[phase] / count,
+                'max': self._maxima[phase],
+                'p50': self._percentile(phase, count, .5),
+                'p90': self._percentile(phase, count, .9),
+                'p99': self._percentile(phase, count, .99),
+                'bytes': self._bytes.get(phase),
+            }
+        return stats
+
+    def histogram(self, phase):
+        """(upper bound in seconds, count) of the non-empty buckets of a phase"""
+        return [(BUCKETS[i] if i < len(BUCKETS) else math.inf, count)
+                for (i, count) in enumerate(self._counts[phase]) if count]
+
+    def summary(self):
+        """One line breakdown of the phases, by decreasing total time"""
+        stats = self.stats()
+        return ', '.join('{} {:.1f}ms/{} (p90 {:.2f}ms)'.format(
+            phase, s['total'] * 1e3, s['count'], s['p90'] * 1e3)
+            for (phase, s) in sorted(stats.items(), key=lambda item: -item[1]['total']))
+
+    def export_chrome_trace(self, path):
+        """Writes the traced calls in the Chrome trace event format"""
+        events = [{'name': phase, 'ph': 'X', 'ts': start * 1e6,
+                   'dur': duration * 1e6, 'pid': os.getpid(), 'tid': thread}
+                  for (phase, start, duration, thread) in self._events]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+    def _percentile(self, phase, count, q):
+        # Upper bound of the bucket holding the q-quantile, capped by the maximum
+        rank = q * count
+        seen = 0
+        for (i, bucket_count) in enumerate(self._counts[phase]):
+            seen += bucket_count
+            if seen >= rank:
+                return min(BUCKETS[i] if i < len(BUCKETS) else math.inf,
+                           self._maxima[phase])
+        return self._maxima[phase]
+
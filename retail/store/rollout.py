@@ -0,0 +1,98 @@
+import torch
+import torch.nn.functional as F
+
+from retail.expression import ORDER_VARIABLES, compile_expression
+
+
+class Trajectory:
+    """Per-step and per-item outcomes of an episode.
+
+    Every field is a (steps, *batch, items) tensor preallocated for the whole
+    horizon, and numpy() returns views sharing the same memory. Steps are the
+    env.step calls, substep_count of them per day.
+    """
+
+    FIELDS = ('reward', 'sales', 'waste', 'availability', 'order')
+
+    def __init__(self, steps, shape, substep_count):
+        self.substep_count = substep_count
+        self.length = 0
+        for field in self.FIELDS:
+            setattr(self, field, torch.zeros((steps, ) + tuple(shape)))
+
+    def record(self, action, reward, info):
+        t = self.length
+        self.reward[t].copy_(torch.as_tensor(reward))
+        self.sales[t].copy_(torch.as_tensor(info.sales))
+        self.waste[t].copy_(torch.as_tensor(info.waste))
+        self.availability[t].copy_(torch.as_tensor(info.availability))
+        self.order[t].copy_(torch.as_tensor(action))
+        self.length += 1
+
+    def trim(self):
+        # Episodes ending early keep views of the filled steps only
+        for field in self.FIELDS:
+            setattr(self, field, getattr(self, field)[:self.length])
+        return self
+
+    def numpy(self):
+        return {field: getattr(self, field).numpy() for field in self.FIELDS}
+
+    def daily(self, field='reward'):
+        """(days, *batch) totals of a field over items and substeps"""
+        values = getattr(self, field)
+        days = self.length // self.substep_count
+        return values[:days * self.substep_count].sum(-1).view(
+            (days, self.substep_count) + values.shape[1:-1]).sum(1)
+
+
+def rollout(env, policy, observe=False, progress=None, seed=None, sink=None):
+    """Run env from reset() until done, recording every step in a Trajectory.
+
+    policy(env) returns the units to order. Observations are only built when
+    observe is True, for policies reading env.get_obs(). progress, if given, is
+    called with (step, steps, trajectory) after every step. A seed makes the
+    episode reproducible without touching the global RNG state. A sink, such
+    as dataset.TrajectoryWriter, also records every step, with the observation
+    the action was taken on when observe is True.
+    """
+    steps = env.horizon * env._substep_count
+    trajectory = Trajectory(steps, env._batch_shape + (env._assortment_size, ),
+                            env._substep_count)
+    env._observe = observe
+    try:
+        with torch.no_grad(), torch.random.fork_rng(devices=[], enabled=seed is not None):
+            if seed is not None:
+                torch.manual_seed(seed)
+            env.reset()
+            for step in range(steps):
+                action = policy(env)
+                if sink is not None and observe:
+                    sink.observe(env.get_obs())
+                (_, reward, done, info) = env.step(action)
+                trajectory.record(action, reward, info)
+                if sink is not None:
+                    sink.record(action, reward, info)
+                if progress is not None:
+                    progress(step + 1, steps, trajectory)
+                if bool(torch.as_tensor(done).all()):
+                    break
+    finally:
+        env._observe = True
+    env._updateObs()
+    return trajectory.trim()
+
+
+def expression_policy(order, n_customers):
+    """Policy ordering the units given by an order expression typed in the app"""
+    expression = compile_expression(order, ORDER_VARIABLES)
+
+    def policy(env):
+        customers = env.bucket_customers.mean().round()
+        forecast = env.forecast.squeeze()
+        std = torch.sqrt(customers * forecast + (1 - forecast))
+        return F.relu(torch.as_tensor(expression(
+            forecast=forecast, n_customers=n_customers, customers=customers,
+            stock=env.get_full_inventory_position(), std=std))).round()
+
+    return policy
@@ -0,0 +1,86 @@
+from math import pi
+
+import torch
+
+
+class SeasonalityTable:
+    """Forecast of every item for every day of the horizon, computed in bulk.
+
+    Rows are computed by chunks of days in one vectorized pass, the whole horizon
+    at once when it fits in `max_elements`, so that a day transition is a row
+    lookup. Profiles are extra multipliers applied on top of the yearly and weekly
+    seasonality: callables mapping a LongTensor of days to a (days, items) or a
+    (days, 1) tensor.
+    """
+
+    def __init__(self, base_demand, phase, phase2, horizon, profiles=(),
+                 max_elements=2 ** 22):
+        self.base_demand = base_demand
+        self.profiles = list(profiles)
+        self._phase = phase
+        self._phase2 = phase2
+        self._chunk_days = max(1, min(horizon + 1, max_elements // phase.numel()))
+        self._start = None
+        self._rows = None
+
+    def __getitem__(self, day):
+        if isinstance(day, torch.Tensor) and day.dim() > 0:
+            # One day per store
+            (first, last) = (int(day.min()), int(day.max()))
+            if last - first >= self._chunk_days:
+                return self.compute(day, aligned=True)
+            self._seek(first, last)
+            return self._rows[day - self._start, torch.arange(len(day))]
+        self._seek(int(day), int(day))
+        return self._rows[int(day) - self._start]
+
+    def compute(self, days, aligned=False):
+        # We want a yearly seasonality - We have a cosinus argument and a phase.
+        # Note that, as we take the absolute value, 2*pi/365 becomes pi/365.
+
+        days = torch.as_tensor(days)
+        if aligned:
+            shape = days.shape + (1, )
+        else:
+            days = days.view(-1)
+            shape = days.shape + (1, ) * self._phase.dim()
+        argument = days.float().mul(pi / 365).view(shape) + self._phase
+        argument2 = days.float().mul(pi / 7).view(shape) + self._phase2
+        rows = self.base_demand * argument.cos().abs() * argument2.cos().abs()
+        for profile in self.profiles:
+            rows = rows * profile(days.view(-1)).view(shape[:-1] + (-1, ))
+        return rows
+
+    def _seek(self, first, last):
+        if self._start is None or first < self._start \
+                or last >= self._start + self._chunk_days:
+            self._start = first
+            self._rows = self.compute(torch.arange(first, first + self._chunk_days))
+
+
+class PeriodicProfile:
+    """Multipliers repeating every len(values) days, e.g. a weekly pattern learnt from data.
+
+    values is either (period, ) for all items or (period, items).
+    """
+
+    def __init__(self, values):
+        self.values = torch.as_tensor(values)
+
+    def __call__(self, days):
+        multipliers = self.values[days % self.values.shape[0]]
+        return multipliers.unsqueeze(-1) if self.values.dim() == 1 else multipliers
+
+
+class HolidayProfile:
+    """Demand spikes on given days of the year, as a {day: multiplier} mapping."""
+
+    def __init__(self, multipliers, period=365):
+        self.multipliers = dict(multipliers)
+        self.period = period
+
+    def __call__(self, days):
+        spikes = torch.ones(len(days), 1)
+        for (day, multiplier) in self.multipliers.items():
+            spikes[days % self.period == day] = multiplier
+        return spikes
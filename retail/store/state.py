@@ -0,0 +1,48 @@
+import zlib
+
+import numpy as np
+import torch
+
+
+# Version of the pickled StoreEnv and Assortment states
+STATE_VERSION = 1
+
+
+def pack(tensor):
+    """Tensor as a (dtype, stored dtype, shape, zlib'd little-endian bytes) tuple.
+
+    Floats holding small integers, such as stock levels and shelf lives, are
+    stored as int16.
+    """
+    array = tensor.detach().cpu().numpy()
+    dtype = array.dtype.newbyteorder('<').str
+    if array.dtype.kind == 'f' and array.size \
+            and np.abs(array).max() < 2 ** 15 and np.array_equal(array, np.round(array)):
+        array = array.astype('<i2')
+    else:
+        array = array.astype(dtype, copy=False)
+    return (dtype, array.dtype.str, array.shape,
+            zlib.compress(np.ascontiguousarray(array).tobytes()))
+
+
+def unpack(packed):
+    (dtype, stored, shape, data) = packed
+    array = np.frombuffer(zlib.decompress(data), dtype=stored).reshape(shape)
+    return torch.from_numpy(array.astype(np.dtype(dtype).newbyteorder('=')))
+
+
+def pack_values(values):
+    # Packs the tensors of a dict, leaving other values to pickle
+    return {key: ('tensor', pack(value)) if isinstance(value, torch.Tensor)
+            else ('value', value) for (key, value) in values.items()}
+
+
+def unpack_values(values):
+    return {key: unpack(value) if kind == 'tensor' else value
+            for (key, (kind, value)) in values.items()}
+
+
+def check_version(state, name):
+    if state.get('version') != STATE_VERSION:
+        raise ValueError("Unsupported {} state version {}, expected {}".format(
+            name, state.get('version'), STATE_VERSION))
@@ -0,0 +1,486 @@
+from typing import Tuple
+
+import numpy as np
+import torch
+from torch import Tensor
+import torch.nn.functional as F
+
+
+# Bytes of stock stepped at once by batched engines, see _by_stores
+CHUNK_BYTES = 2 ** 22
+
+
+class DenseStock:
+    """Stock as an (items x max_stock) matrix, one cell per unit holding its remaining shelf life.
+
+    The matrix may carry leading batch dimensions to simulate several stores at once.
+    """
+
+    def __init__(self, shelf_lives, max_stock, batch_shape=()):
+        self.size = shelf_lives.shape[0]
+        self.max_stock = max_stock
+        self.stock = torch.zeros(tuple(batch_shape) + (self.size, max_stock))
+        self.shelf_lives = shelf_lives
+        self._slots = torch.arange(max_stock)
+
+    def add(self, units):
+        (self.stock, overflow) = _by_stores(self._add, self.stock, 2, units, update=True)
+        return overflow
+
+    def remove(self, units):
+        (self.stock, ) = _by_stores(self._remove, self.stock, 2, units, update=True)
+
+    def count(self):
+        return _by_stores(lambda stock: (stock.ge(1).sum(-1).float(), ), self.stock, 2)[0]
+
+    def expiring(self):
+        return _by_stores(lambda stock: (stock.eq(1).sum(-1).float(), ), self.stock, 2)[0]
+
+    def age(self):
+        (self.stock, ) = _by_stores(lambda stock: (F.relu(stock - 1), ), self.stock, 2,
+                                    update=True)
+
+    def matrix(self):
+        # Units sorted by decreasing shelf life, whatever their slots
+        return _by_stores(lambda stock: (stock.sort(-1, descending=True)[0], ),
+                          self.stock, 2)[0]
+
+    def age_profile(self, bins):
+        return _by_stores(self._ageProfile, self.stock, 2, bins=bins)[0]
+
+    def state_dict(self):
+        return {'stock': self.stock}
+
+    def load_state_dict(self, state):
+        self.stock = state['stock']
+
+    def _add(self, stock, units):
+        # New units fill the first slots of each row, the stock sorted ascending the last ones
+        restock = self.shelf_lives.unsqueeze(-1) \
+            * self._slots.lt(units.long().unsqueeze(-1)).float()
+        stock = stock.sort(-1)[0] + restock
+        total_units = restock.ge(1).sum(-1) + stock.ge(1).sum(-1)
+        return (stock, F.relu(total_units - self.max_stock).float())
+
+    def _remove(self, stock, units):
+        # Sold units are the first slots of each row sorted descending
+        kept = self._slots.ge(units.long().unsqueeze(-1)).float()
+        return (kept * stock.sort(-1, descending=True)[0], )
+
+    def _ageProfile(self, stock, bins):
+        # Units by remaining fraction of their shelf life, in `bins` equal bins
+        fraction = stock / self.shelf_lives.clamp(min=1).unsqueeze(-1)
+        index = fraction.mul_(bins).ceil_().clamp_(1, bins).long() - 1
+        return (torch.zeros(stock.shape[:-1] + (bins, )).scatter_add_(
+            -1, index, stock.ge(1).float()), )
+
+
+class HistogramStock:
+    """Stock as per-item unit counts bucketed by remaining shelf life.
+
+    The buckets of all items lie end to end along the last dimension of counts:
+    an item of shelf life L has span * L + 1 of them, bucket k holding the
+    number of units with k days left and bucket 0 always empty. Restock, sale,
+    waste and aging cost O(sum of shelf lives) and never sort, which pays off
+    whenever shelf lives are short compared to max_stock. Counts may carry
+    leading batch dimensions to simulate several stores at once.
+    Behaves exactly like DenseStock, including when an order overflows
+    max_stock: the oldest units on the shelf absorb the shelf life of the
+    overflowing ones, again and again with repeated overflows. The span starts
+    at 2 and doubles, see reserve, whenever units live long enough to be
+    extended beyond it.
+    """
+
+    def __init__(self, shelf_lives, max_stock, batch_shape=()):
+        self.size = shelf_lives.shape[0]
+        self.max_stock = max_stock
+        self.shelf_lives = shelf_lives
+        self._stocked = shelf_lives.ge(1)
+        self._double = _needs_double(self.size, max_stock)
+        self._setSpan(2)
+        self.counts = torch.zeros(tuple(batch_shape) + (int(self._widths.sum()), ))
+
+    def add(self, units):
+        self.reserve()
+        (self.counts, overflow) = _by_stores(self._add, self.counts, 1, units,
+                                             items=self._items(), update=True)
+        return overflow
+
+    def reserve(self):
+        """Doubles the span if an overflow could extend lives beyond it, returns whether it did.
+
+        Overflows add a shelf life to units, so only units of more than
+        span - 1 shelf lives can outgrow the buckets.
+        """
+        if not bool(self.counts.index_select(-1, self._oldest).any()):
+            return False
+        self._widen(2 * self._span)
+        return True
+
+    def remove(self, units):
+        (self.counts, ) = _by_stores(self._remove, self.counts, 1, units,
+                                     items=self._items(), update=True)
+
+    def count(self):
+        return _by_stores(lambda counts: (histogram_count(
+            counts, self._starts, self._lasts, self._double), ), self.counts, 1)[0]
+
+    def expiring(self):
+        return histogram_expiring(self.counts, self._starts, self._lasts)
+
+    def age(self):
+        (self.counts, ) = _by_stores(lambda counts: (histogram_age(counts, self._starts), ),
+                                     self.counts, 1, update=True)
+
+    def matrix(self):
+        return _by_stores(self._matrix, self.counts, 1, items=self._items())[0]
+
+    def age_profile(self, bins):
+        return _by_stores(self._ageProfile, self.counts, 1, bins=bins,
+                          items=self._items())[0]
+
+    def state_dict(self):
+        return {'counts': self.counts}
+
+    def load_state_dict(self, state):
+        # States of narrower spans, as saved before a widening, are widened
+        span = self._span
+        if state['counts'].shape[-1] != self.counts.shape[-1]:
+            self._setSpan(_spanOf(state['counts'].shape[-1], self.shelf_lives, span))
+        self.counts = state['counts']
+        if self._span < span:
+            self._widen(span)
+
+    def _items(self):
+        # Item of every bucket, built on demand rather than kept next to the counts
+        return torch.repeat_interleave(self._widths)
+
+    def _setSpan(self, span):
+        lives = self.shelf_lives.long()
+        self._span = span
+        self._widths = span * lives + 1
+        self._starts = self._widths.cumsum(0) - self._widths
+        # Bucket of new units and last bucket of every item
+        self._lives = self._starts + lives
+        self._lasts = self._starts + span * lives
+        # Buckets of units more than span - 1 shelf lives away from expiring
+        items = self._items()
+        days = torch.arange(int(self._widths.sum())) - self._starts.index_select(0, items)
+        self._oldest = torch.nonzero(days.gt((span - 1) * lives.index_select(0, items))).view(-1)
+
+    def _widen(self, span):
+        # Moves the buckets of every item to where they lie with the new span
+        (starts, items) = (self._starts, self._items())
+        self._setSpan(span)
+        buckets = torch.arange(self.counts.shape[-1]) \
+            + (self._starts - starts).index_select(0, items)
+        self.counts = torch.zeros(self.counts.shape[:-1] + (int(self._widths.sum()), )) \
+            .index_copy_(-1, buckets, self.counts)
+
+    def _add(self, counts, units, items):
+        return histogram_add(counts, units, self._lives, self._starts, self._lasts, items,
+                             self._stocked, self.max_stock, self._double, False)
+
+    def _remove(self, counts, units, items):
+        return (histogram_remove(counts, units, self._lasts, items, self._double), )
+
+    def _matrix(self, counts, items):
+        # Units sorted by decreasing shelf life: slot p holds the number of buckets
+        # k >= 1 with more than p units at k days or more
+        cumulative = _cumsum(counts, self._double)
+        at_least = cumulative.index_select(-1, self._lasts).index_select(-1, items) \
+            - cumulative + counts
+        index = at_least.long().clamp_(max=self.max_stock)
+        index.index_fill_(-1, self._starts, self.max_stock)
+        drops = torch.zeros(counts.shape[:-1] + (self.size * (self.max_stock + 1), ))
+        drops.scatter_add_(-1, index + items * (self.max_stock + 1), torch.ones_like(counts))
+        drops = drops.view(counts.shape[:-1] + (self.size, self.max_stock + 1))
+        return ((self._widths - 1).float().unsqueeze(-1) - drops.cumsum(-1)[..., :-1], )
+
+    def _ageProfile(self, counts, bins, items):
+        # Units by remaining fraction of their shelf life, in `bins` equal bins
+        days = torch.arange(counts.shape[-1]) - self._starts.index_select(0, items)
+        fractions = days.float() / self.shelf_lives.clamp(min=1).index_select(0, items)
+        index = (fractions * bins).ceil_().clamp_(1, bins).long() - 1 + items * bins
+        profile = torch.zeros(counts.shape[:-1] + (self.size * bins, )).scatter_add_(
+            -1, index.expand_as(counts), counts)
+        return (profile.view(counts.shape[:-1] + (self.size, bins)), )
+
+
+def _by_stores(fn, state, dims, *args, update=False, **kwargs):
+    """fn(state, *args, **kwargs), returning a tuple, over slices of the stores of state.
+
+    state has leading batch dimensions before its last dims, split into slices
+    of at most CHUNK_BYTES of which the allocator reuses the temporaries, rather
+    than mapping fresh pages for every operation of large batches. args share
+    the batch dimensions, kwargs do not. With update, fn returns the new state
+    first, written into state.
+    """
+    batch_shape = state.shape[:state.dim() - dims]
+    stores = int(np.prod(batch_shape))
+    step = max(1, CHUNK_BYTES * stores // max(state.numel() * state.element_size(), 1))
+    if stores <= step:
+        return fn(state, *args, **kwargs)
+    state = state.contiguous()
+    rows = state.view((stores, ) + state.shape[len(batch_shape):])
+    args = [arg.reshape((stores, ) + arg.shape[len(batch_shape):]) for arg in args]
+    outputs = []
+    for start in range(0, stores, step):
+        chunk = rows[start:start + step]
+        output = fn(chunk, *(arg[start:start + step] for arg in args), **kwargs)
+        if update:
+            if output[0].data_ptr() != chunk.data_ptr():
+                chunk.copy_(output[0])
+            output = output[1:]
+        outputs.append(output)
+    outputs = tuple(torch.cat(parts).view(batch_shape + parts[0].shape[1:])
+                    for parts in zip(*outputs))
+    return ((state, ) + outputs) if update else outputs
+
+
+# HistogramStock operations, in TorchScript for kernels.StepKernel. Every item
+# spans buckets starts to lasts of counts, items gives the item of each bucket.
+
+def histogram_count(counts: Tensor, starts: Tensor, lasts: Tensor, double: bool) -> Tensor:
+    cumulative = _cumsum(counts, double)
+    # Bucket 0 is empty, so the sum up to it is that of the items before
+    return (cumulative.index_select(-1, lasts)
+            - cumulative.index_select(-1, starts)).to(counts.dtype)
+
+
+def histogram_expiring(counts: Tensor, starts: Tensor, lasts: Tensor) -> Tensor:
+    # Items of zero shelf life have no bucket 1
+    return counts.index_select(-1, torch.min(starts + 1, lasts))
+
+
+def histogram_age(counts: Tensor, starts: Tensor) -> Tensor:
+    # Bucket k + 1 moves to bucket k, units left in buckets 0 are gone
+    return F.pad(counts[..., 1:], [0, 1]).index_fill_(-1, starts, 0.)
+
+
+def histogram_add(counts: Tensor, units: Tensor, lives: Tensor, starts: Tensor, lasts: Tensor,
+                  items: Tensor, stocked: Tensor, max_stock: int, double: bool,
+                  branchless: bool) -> Tuple[Tensor, Tensor]:
+    # Without branchless, overflows are only merged when there are some
+    units = units.float() * stocked
+    on_hand = histogram_count(counts, starts, lasts, double)
+    overflow = F.relu(on_hand + units - max_stock)
+    if branchless or bool(overflow.any()):
+        # The first overflow units of each item, from bucket 1 up, gain its shelf life
+        cumulative = _cumsum(counts, double)
+        before = cumulative - counts - cumulative.index_select(-1, starts).index_select(-1, items)
+        merged = _take(counts, overflow.index_select(-1, items), before)
+        extended = torch.min(torch.arange(counts.shape[-1]) + (lives - starts).index_select(0, items),
+                             lasts.index_select(0, items))
+        counts = counts.sub_(merged).scatter_add_(-1, extended.expand_as(counts), merged)
+    counts = counts.scatter_add_(-1, lives.expand_as(units), units - overflow)
+    counts = counts.index_fill_(-1, starts, 0.)
+    total_units = units + (on_hand + units).clamp(max=max_stock)
+    return (counts, F.relu(total_units - max_stock))
+
+
+def histogram_remove(counts: Tensor, units: Tensor, lasts: Tensor, items: Tensor,
+                     double: bool) -> Tensor:
+    # Sells the freshest units first: bucket k loses what units leave after
+    # the units of longer lives
+    cumulative = _cumsum(counts, double)
+    left = units.to(cumulative.dtype) - cumulative.index_select(-1, lasts)
+    return counts.sub_(_take(counts, left.index_select(-1, items), -cumulative))
+
+
+def _take(counts: Tensor, units: Tensor, before: Tensor) -> Tensor:
+    # Units drained from each bucket when `before` units are drained ahead of it
+    return torch.min((units - before).clamp_(min=0).to(counts.dtype), counts)
+
+
+def _cumsum(counts: Tensor, double: bool) -> Tensor:
+    if double:
+        return counts.double().cumsum(-1)
+    return counts.cumsum(-1)
+
+
+def _spanOf(buckets, shelf_lives, default):
+    # Span of histogram counts of that many buckets, any for shelf lives of 0
+    lives = int(np.asarray(shelf_lives).astype(np.int64).sum())
+    return (buckets - len(shelf_lives)) // lives if lives else default
+
+
+def _needs_double(size, max_stock):
+    # Cumulative counts of float32 are exact up to 2 ** 24 units
+    return size * max_stock >= 2 ** 24
+
+
+class NumpyDenseStock:
+    """DenseStock on a float32 NumPy matrix, giving the same results, see NumpyStoreEnv."""
+
+    def __init__(self, shelf_lives, max_stock):
+        shelf_lives = np.asarray(shelf_lives, dtype=np.float32)
+        self.size = shelf_lives.shape[0]
+        self.max_stock = max_stock
+        self.stock = np.zeros((self.size, max_stock), dtype=np.float32)
+        self.shelf_lives = shelf_lives
+        self._slots = np.arange(max_stock)
+
+    def add(self, units):
+        # New units fill the first slots of each row, the stock sorted ascending the last ones
+        restock_matrix = np.where(self._slots < units.astype(np.int64)[:, None],
+                                  self.shelf_lives[:, None], np.float32(0))
+        self.stock = np.sort(self.stock, 1) + restock_matrix
+        total_units = (restock_matrix >= 1).sum(1) + (self.stock >= 1).sum(1)
+        return np.maximum(total_units - self.max_stock, 0).astype(np.float32)
+
+    def remove(self, units):
+        # Sold units are the first slots of each row sorted descending
+        kept = self._slots >= units.astype(np.int64)[:, None]
+        self.stock = np.sort(self.stock, 1)[:, ::-1] * kept
+
+    def count(self):
+        return (self.stock >= 1).sum(1).astype(np.float32)
+
+    def expiring(self):
+        return (self.stock == 1).sum(1).astype(np.float32)
+
+    def age(self):
+        self.stock = np.maximum(self.stock - 1, 0)
+
+    def matrix(self):
+        # Contiguous, for torch.from_numpy
+        return -np.sort(-self.stock, -1)
+
+    def age_profile(self, bins):
+        fraction = self.stock / np.maximum(self.shelf_lives, 1)[:, None]
+        index = np.clip(np.ceil(fraction * bins), 1, bins).astype(np.int64) - 1
+        return _bincount_rows(index, (self.stock >= 1).astype(np.float32), bins)
+
+    def state_dict(self):
+        return {'stock': torch.from_numpy(self.stock)}
+
+    def load_state_dict(self, state):
+        self.stock = torch.as_tensor(state['stock']).numpy()
+
+
+class NumpyHistogramStock:
+    """HistogramStock on float32 NumPy counts, giving the same results, see NumpyStoreEnv."""
+
+    def __init__(self, shelf_lives, max_stock, batch_shape=()):
+        shelf_lives = np.asarray(shelf_lives, dtype=np.float32)
+        self.size = shelf_lives.shape[0]
+        self.max_stock = max_stock
+        self.shelf_lives = shelf_lives
+        self._stocked = shelf_lives >= 1
+        self._dtype = np.float64 if _needs_double(self.size, max_stock) else np.float32
+        self._setSpan(2)
+        self.counts = np.zeros(tuple(batch_shape) + (int(self._widths.sum()), ),
+                               dtype=np.float32)
+
+    def add(self, units):
+        self.reserve()
+        units = units.astype(np.float32) * self._stocked
+        on_hand = self.count()
+        overflow = np.maximum(on_hand + units - self.max_stock, 0)
+        if overflow.any():
+            cumulative = self.counts.cumsum(-1, dtype=self._dtype)
+            before = cumulative - self.counts - self._spread(cumulative[..., self._starts])
+            merged = self._take(self._spread(overflow), before)
+            extended = np.minimum(np.arange(self.counts.shape[-1])
+                                  + self._spread(self._lives - self._starts),
+                                  self._spread(self._lasts))
+            self.counts -= merged
+            self.counts += _bincount_rows(np.broadcast_to(extended, self.counts.shape),
+                                          merged, self.counts.shape[-1])
+        self.counts[..., self._lives] += units - overflow
+        self.counts[..., self._starts] = 0.
+        total_units = units + np.minimum(on_hand + units, np.float32(self.max_stock))
+        return np.maximum(total_units - self.max_stock, 0)
+
+    def remove(self, units):
+        cumulative = self.counts.cumsum(-1, dtype=self._dtype)
+        left = units.astype(self._dtype) - cumulative[..., self._lasts]
+        self.counts -= self._take(self._spread(left), -cumulative)
+
+    def count(self):
+        cumulative = self.counts.cumsum(-1, dtype=self._dtype)
+        return (cumulative[..., self._lasts] - cumulative[..., self._starts]).astype(np.float32)
+
+    def expiring(self):
+        return self.counts[..., np.minimum(self._starts + 1, self._lasts)]
+
+    def age(self):
+        counts = np.zeros_like(self.counts)
+        counts[..., :-1] = self.counts[..., 1:]
+        counts[..., self._starts] = 0.
+        self.counts = counts
+
+    def matrix(self):
+        cumulative = self.counts.cumsum(-1, dtype=self._dtype)
+        at_least = self._spread(cumulative[..., self._lasts]) - cumulative + self.counts
+        index = np.minimum(at_least.astype(np.int64), self.max_stock)
+        index[..., self._starts] = self.max_stock
+        index += self._spread(np.arange(self.size) * (self.max_stock + 1))
+        drops = _bincount_rows(index, np.ones_like(self.counts), self.size * (self.max_stock + 1))
+        drops = drops.reshape(self.counts.shape[:-1] + (self.size, self.max_stock + 1))
+        return (self._widths - 1).astype(np.float32)[:, None] - drops.cumsum(-1)[..., :-1]
+
+    def age_profile(self, bins):
+        days = np.arange(self.counts.shape[-1]) - self._spread(self._starts)
+        fractions = days.astype(np.float32) / self._spread(np.maximum(self.shelf_lives, 1))
+        index = np.clip(np.ceil(fractions * bins), 1, bins).astype(np.int64) - 1 \
+            + self._spread(np.arange(self.size) * bins)
+        profile = _bincount_rows(np.broadcast_to(index, self.counts.shape), self.counts,
+                                 self.size * bins)
+        return profile.reshape(self.counts.shape[:-1] + (self.size, bins))
+
+    def state_dict(self):
+        return {'counts': torch.from_numpy(self.counts)}
+
+    def load_state_dict(self, state):
+        counts = torch.as_tensor(state['counts']).numpy()
+        span = self._span
+        if counts.shape[-1] != self.counts.shape[-1]:
+            self._setSpan(_spanOf(counts.shape[-1], self.shelf_lives, span))
+        self.counts = counts
+        if self._span < span:
+            self._widen(span)
+
+    def reserve(self):
+        """See HistogramStock.reserve"""
+        if not self.counts[..., self._oldest].any():
+            return False
+        self._widen(2 * self._span)
+        return True
+
+    def _setSpan(self, span):
+        lives = self.shelf_lives.astype(np.int64)
+        self._span = span
+        self._widths = span * lives + 1
+        self._starts = self._widths.cumsum() - self._widths
+        self._lives = self._starts + lives
+        self._lasts = self._starts + span * lives
+        days = np.arange(int(self._widths.sum())) - self._spread(self._starts)
+        self._oldest = np.flatnonzero(days > self._spread((span - 1) * lives))
+
+    def _widen(self, span):
+        (starts, widths) = (self._starts, self._widths)
+        self._setSpan(span)
+        buckets = np.arange(self.counts.shape[-1]) \
+            + np.repeat(self._starts - starts, widths)
+        counts = np.zeros(self.counts.shape[:-1] + (int(self._widths.sum()), ),
+                          dtype=np.float32)
+        counts[..., buckets] = self.counts
+        self.counts = counts
+
+    def _spread(self, values):
+        # Per-item values repeated over the buckets of every item
+        return np.repeat(values, self._widths, axis=-1)
+
+    def _take(self, units, before):
+        return np.minimum(np.maximum(units - before, 0).astype(np.float32), self.counts)
+
+
+def _bincount_rows(index, weights, length):
+    # Sums weights by index along the last dimension, like scatter_add_ into zeros
+    rows = index.reshape(-1, index.shape[-1])
+    offsets = np.arange(rows.shape[0])[:, None] * length
+    sums = np.bincount((rows + offsets).ravel(), weights.reshape(-1),
+                       rows.shape[0] * length)
+    return sums.reshape(index.shape[:-1] + (length, )).astype(np.float32)
@@ -1,13 +1,12 @@
 from collections import namedtuple
+import copy
+import inspect
 import logging
 from math import pi
 import numpy as np
 
 import torch
 import torch.distributions as d
-import torch.nn.functional as F
-
-import plotly.express as px
 
 from rlpyt.envs.base import Env, EnvStep
 from rlpyt.spaces.int_box import IntBox
@@ -17,6 +16,15 @@ from rlpyt.utils.quick_args import save__init__args
 from retail.utility import LinearUtility, LogLinearUtility, CobbDouglasUtility, HomogeneousReward
 
 from .assortment import Assortment
+from .demand import BernoulliDemand, BinomialDemand, PoissonDemand, NegativeBinomialDemand
+from .kernels import compile_step, set_layout
+from .pipeline import OrderPipeline
+from .rollout import expression_policy, rollout
+from .seasonality import SeasonalityTable
+from .state import STATE_VERSION, check_version, pack_values, unpack_values
+from .stock import DenseStock, HistogramStock
+from .streams import RandomStreams
+from .transportation import TransportationCost
 
 
 EnvInfo = namedtuple('EnvInfo',
@@ -25,6 +33,11 @@ EnvInfo = namedtuple('EnvInfo',
 
 class StoreEnv(Env):
 
+    # Leading dimensions of the per-store state, empty for a single store
+    _batch_shape = ()
+    # Whether steps build observations, see rollout.rollout
+    _observe = True
+
     def __init__(
         self,
         assortment_size=1000,  # number of items to train
@@ -46,6 +59,16 @@ class StoreEnv(Env):
         lead_time=1,  # Defines how quickly the orders goes through the buffer - also impacts the relevance of the observation
         lead_time_fast=0,
         symmetric_action_space=False,
+        stock_engine='dense',  # 'dense' keeps one cell per unit, 'histogram' counts units by remaining shelf life
+        demand_model='binomial',
+        assortment_backend='numpy',  # 'r' samples the assortment copula with R instead
+        seasonality_profiles=(),  # Extra demand multipliers, see seasonality.PeriodicProfile and HolidayProfile
+        observation_mode='full',  # 'compact' replaces the stock matrix by units per shelf life fraction
+        age_bins=4,  # Shelf life fraction bins of the compact observations
+        carriers=(),  # Carriers charged for every order, see transportation.TransportationCost
+        step_kernel='eager',  # 'script' or 'compile' fuse each step into a compiled kernels.StepKernel
+        rng='global',  # 'streams' pre-samples customers, forecast noise and demand, see streams.RandomStreams
+        stream_days=28,  # Days of random streams sampled at once
     ):
         save__init__args(locals(), underscore=True)
         logging.info("Creating new StoreEnv")
@@ -60,21 +83,26 @@ class StoreEnv(Env):
         else:
             self._action_space = IntBox(low=0, high=max_stock,
                                         shape=[assortment_size])
-        self.stock = torch.zeros(assortment_size, max_stock,
-                                 requires_grad=False)
 
         # correct high with max shelf life
 
+        if observation_mode == 'full':
+            stock_width = max_stock
+        elif observation_mode == 'compact':
+            stock_width = age_bins
+        else:
+            raise ValueError("Unknown observation mode '{}'".format(observation_mode))
         self._observation_space = FloatBox(low=0, high=1000,
-                                           shape=(assortment_size, max_stock + characDim
+                                           shape=(assortment_size, stock_width + characDim
                                                   + lead_time + lead_time_fast + 1))
         self._horizon = int(horizon)
-        self.assortment = Assortment(assortment_size, freshness, seed)
-        self._repeater = torch.stack((self.assortment.shelf_lives,
-                                      torch.zeros(self._assortment_size))).transpose(0,
-                                                                                     1).reshape(-1).detach()
-        self.forecast = torch.zeros(assortment_size, 1)  # DAH forecast.
+        self.assortment = Assortment(assortment_size, freshness, seed,
+                                     assortment_backend)
+        self._stock = self._createStock(stock_engine)
+        self.transportation = self._createTransportation(carriers)
+        self.forecast = torch.zeros(self._batch_shape + (assortment_size, 1))  # DAH forecast.
         self._step_counter = 0
+        self._episode = 0
 
         # Needs to move towards env parameters
 
@@ -83,16 +111,24 @@ class StoreEnv(Env):
                                                      bucket_cov)
         self.assortment.base_demand = \
             self.assortment.base_demand.detach() \
-            / bucket_customers.sum()
+            / bucket_customers.sum(-1, keepdim=True)
         self._bias = d.normal.Normal(forecastBias, forecastVariance)
+        if demand_model == 'bernoulli':
+            self._demand = BernoulliDemand()
+        elif demand_model == 'binomial':
+            self._demand = BinomialDemand()
+        elif demand_model == 'poisson':
+            self._demand = PoissonDemand()
+        elif demand_model == 'negative_binomial':
+            self._demand = NegativeBinomialDemand()
+        else:
+            self._demand = demand_model
 
-        # We want a yearly seasonality - We have a cosinus argument and a phase.
-        # Note that, as we take the absolute value, 2*pi/365 becomes pi/365.
-
-        self._year_multiplier = torch.arange(0.0, horizon, pi / 365)
-        self._week_multiplier = torch.arange(0.0, horizon, pi / 7)
-        self._phase = 2 * pi * torch.rand(assortment_size)
-        self._phase2 = 2 * pi * torch.rand(assortment_size)
+        self._streams = self._createStreams(rng)
+        (self._phase, self._phase2) = self._drawPhases()
+        self._seasonality = SeasonalityTable(self.assortment.base_demand,
+                                             self._phase, self._phase2,
+                                             self._horizon, seasonality_profiles)
         self.create_buffers(lead_time, lead_time_fast)
         if utility_function == 'linear':
             self.utility_function = LinearUtility(**utility_weights)
@@ -104,148 +140,390 @@ class StoreEnv(Env):
             self.utility_function = HomogeneousReward(**utility_weights)
         else:
             self.utility_function = utility_function
+        self._allocateObs()
         self._updateEnv()
         for i in range(self._lead_time):
-            units_to_order = torch.as_tensor(self.forecast.squeeze()
-                            * bucket_customers[i]).round().clamp(0, self._max_stock)
+            units_to_order = torch.as_tensor(self.forecast.squeeze(-1)
+                            * bucket_customers[..., i:i + 1]).round().clamp(0, self._max_stock)
             self._addStock(units_to_order)
+        self._kernel = self._createKernel(step_kernel)
+        self._kernel_pending = False
 
     def reset(self):
         self._updateObs()
         self._step_counter = 0
+        self._episode += 1
         return self.get_obs()
 
+    def __getstate__(self):
+        # Generation parameters and mutable state only, derived tables are
+        # rebuilt on load, as well as seeded assortments
+        state = self._get_mutable_state()
+        # The forecast is usually the seasonality row of the current day, and
+        # the real demand probability the forecast itself without noise
+        if torch.equal(self.forecast,
+                       self._seasonality[self._step_counter].unsqueeze(-1)):
+            del state['forecast']
+        if torch.equal(self.real, self.forecast.squeeze(-1)):
+            del state['real']
+        state.update(phase=self._phase, phase2=self._phase2)
+        if self._streams is not None:
+            state.update(stream_seed=self._streams.seed)
+        return {'version': STATE_VERSION,
+                'params': pack_values(self._get_init_params()),
+                'assortment': self.assortment if self._seed is None else None,
+                'state': pack_values(state)}
+
+    def __setstate__(self, state):
+        check_version(state, 'StoreEnv')
+        params = unpack_values(state['params'])
+        with torch.random.fork_rng(devices=[]):
+            # Restored stores often never step, as in the app, so kernels are
+            # only compiled on the first step
+            self.__init__(**dict(params, step_kernel='eager'))
+        self._step_kernel = params.get('step_kernel', 'eager')
+        self._kernel_pending = self._step_kernel != 'eager'
+        replaced = state['assortment'] is not None
+        if replaced:
+            self.assortment = state['assortment']
+            self._allocateObs()
+            self.transportation = self._createTransportation(self._carriers)
+        state = unpack_values(state['state'])
+        (self._phase, self._phase2) = (state.pop('phase'), state.pop('phase2'))
+        if 'stream_seed' in state:
+            self._streams = self._createStreams(self._rng, state.pop('stream_seed'))
+        self._seasonality = SeasonalityTable(self.assortment.base_demand,
+                                             self._phase, self._phase2,
+                                             self._horizon,
+                                             self._seasonality_profiles)
+        self._stock = self._createStock(self._stock_engine)
+        state.setdefault('forecast',
+                         self._seasonality[state['step_counter']].unsqueeze(-1))
+        state.setdefault('real', state['forecast'].squeeze(-1).clone())
+        self._set_mutable_state(state)
+        self._updateObs()
+
+    def snapshot(self):
+        """Copy of the mutable state and of the torch RNG state, see restore"""
+        state = {key: _copy(value) for (key, value) in self._get_mutable_state().items()}
+        state['rng_state'] = torch.get_rng_state()
+        return state
+
+    def restore(self, snapshot, rng=True):
+        """Rewinds to a snapshot of this store or of the one it was forked from.
+
+        With rng, the global torch RNG is rewound too, so that the same actions
+        replay the same demand.
+        """
+        self._set_mutable_state({key: _copy(value) for (key, value) in snapshot.items()
+                                 if key != 'rng_state'})
+        self._updateObs()
+        if rng:
+            torch.set_rng_state(snapshot['rng_state'])
+
+    def fork(self, n=1):
+        """n stores continuing from the current state.
+
+        Forks share the assortment, distributions and seasonality table with this
+        store, and only copy the stock, order buffers and episode counters.
+        """
+        state = self._get_mutable_state()
+        forks = []
+        for _ in range(n):
+            # Bypasses __getstate__, which would rebuild everything
+            env = object.__new__(type(self))
+            # Leaves out the timed methods of a running StepProfiler, which are
+            # bound to this store
+            env.__dict__.update((key, value) for (key, value) in self.__dict__.items()
+                                if not getattr(value, 'profiled', False))
+            (env._stock, env._buffer, env._buffer_fast) = \
+                (copy.copy(self._stock), copy.copy(self._buffer),
+                 copy.copy(self._buffer_fast))
+            env._set_mutable_state({key: _copy(value) for (key, value) in state.items()})
+            env._allocateObs()
+            env._obs.copy_(self._obs)
+            forks.append(env)
+        return forks
+
     def step(self, action):
-        if self._symmetric_action_space:
-            new_action = torch.as_tensor(action.round().clip(0,
-                                                             self._max_stock) + self._max_stock / 2,
-                                         dtype=torch.int32)
+        new_action = self._action(action)
+        end_of_day = self.day_position % self._substep_count == 0
+        if not end_of_day:
+            self.day_position += 1
+        if self._kernel_pending:
+            (self._kernel, self._kernel_pending) = (self._createKernel(self._step_kernel), False)
+        if self._kernel is not None:
+            (sales, availability, waste, utility) = self._kernelStep(new_action, end_of_day)
         else:
-            new_action = torch.as_tensor(action,
-                                         dtype=torch.int32).clamp(0, self._max_stock)
-        if self.day_position % self._substep_count == 0:
-            order_cost = self._make_fast_order(new_action)
-            (sales, availability) = \
-                self._generateDemand(self.real.clamp_(0.0, 1.))
-            waste = self._waste()  # Update waste and store result
-            self._reduceShelfLives()
+            if end_of_day:
+                order_cost = self._make_fast_order(new_action)
+                (sales, availability) = \
+                    self._generateDemand(self.real.clamp_(0.0, 1.))
+                waste = self._waste()  # Update waste and store result
+                self._reduceShelfLives()
+            else:
+                order_cost = self._make_order(new_action)
+                (sales, availability) = \
+                    self._generateDemand(self.real.clamp_(0.0, 1.))
+                waste = 0  # By default, no waste before the end of day
+            sales -= order_cost
+            utility = self.utility_function.reward(sales, waste, availability)
+        if end_of_day:
             self._step_counter += 1
             self._updateEnv()
         else:
-
-            self.day_position += 1
-            order_cost = self._make_order(new_action)
-            (sales, availability) = \
-                self._generateDemand(self.real.clamp_(0.0, 1.))
-            waste = 0  # By default, no waste before the end of day
             self._updateObs()
-        sales.sub_(order_cost)
-        utility = self.utility_function.reward(sales, waste, availability)
         done = self._step_counter == self.horizon
         info = EnvInfo(sales=sales, availability=availability,
                        waste=waste, reward=utility, traj_done=done)
         return EnvStep(self.get_obs(), utility, done, info)
 
+    def _kernelStep(self, units, end_of_day):
+        # Everything but observations and forecasts, see kernels.StepKernel
+        buffer = self._buffer_fast if end_of_day else self._buffer
+        shipping = None
+        if self.transportation is not None:
+            shipping = self._shippingCost(units, buffer.lead_time)
+        if self._kernel.histogram:
+            # Buckets widen with extended lives, see HistogramStock.reserve
+            self._stock.reserve()
+            if self._kernel.span != self._stock._span:
+                set_layout(self._kernel, self._stock)
+        ((name, stock), ) = self._stock.state_dict().items()
+        # In the grad mode of compilation, see kernels._warmUp
+        with torch.no_grad():
+            (stock, sales, availability, waste, utility) = self._kernel(
+                stock, buffer._slots, buffer.in_transit, *self._slotIndices(buffer),
+                units.reshape(self._batch_shape + (-1, )), shipping, self.real,
+                self._indices[self.day_position - 1], self._streamDemand(), end_of_day)
+        buffer._head = (buffer._head + 1) % (buffer.lead_time + 1)
+        self._stock.load_state_dict({name: stock})
+        return (sales, availability, waste if end_of_day else 0, utility)
+
+    def _slotIndices(self, buffer):
+        # One-element indices of the slots of a new order and of the arrivals
+        depth = buffer.lead_time + 1
+        return (self._indices[(buffer._head + buffer.lead_time) % depth],
+                self._indices[buffer._head])
+
+    def _action(self, action):
+        # Units ordered per item
+        if self._symmetric_action_space:
+            return (torch.as_tensor(action).round().clamp(0, self._max_stock)
+                    + self._max_stock / 2).int()
+        return torch.as_tensor(action, dtype=torch.int32).clamp(0, self._max_stock)
+
     def get_obs(self):
+        # Updated in place by the next step, callers keeping it need a copy
         return self._obs
 
     def run_to_completion(self, order, n_customers):
-        done = False
-        obs = self.reset()
-        rewards = []
-        while not done:
-            customers = self.bucket_customers.mean().round()
-            stock = self.get_full_inventory_position()
-            forecast = self.forecast.squeeze()
-            std = torch.sqrt(customers*forecast+(1-forecast))
-            number = F.relu(eval(order)).round()
-            # Step the environment and get its observation
-            obs = self.step(number.numpy())
-            # Store reward for the specific time step
-            rewards.append(obs[1].sum())
-            done = obs[2]
-        return rewards
-
-    def plot_rewards(self, rewards, horizon):
-        somme = np.sum(torch.stack(rewards).numpy().reshape(-1, 4), axis=1)
-        fig = px.line(x=np.arange(0, horizon, 1), y=np.round(somme, 2),
-                      title='Daily Utility value',
-                      labels={'x': 'Time step', 'y': 'Utility'})
-        return fig
+        # Rejects invalid policies before simulating anything
+        return rollout(self, expression_policy(order, n_customers))
+
+    def plot_rewards(self, trajectory, horizon=None):
+        return plot_daily_rewards(trajectory.daily('reward').numpy())
 
     # ##########################################################################
     # Helpers
 
+    def _get_init_params(self):
+        names = list(inspect.signature(StoreEnv.__init__).parameters)[1:]
+        return {name: getattr(self, '_' + name) for name in names}
+
+    def _get_mutable_state(self):
+        # Episode state, referencing the tensors updated in place
+        state = {'step_counter': self._step_counter,
+                 'episode': self._episode,
+                 'day_position': self.day_position,
+                 'forecast': self.forecast, 'real': self.real}
+        parts = {'buffer': self._buffer, 'buffer_fast': self._buffer_fast}
+        if hasattr(self._stock, 'state_dict'):
+            parts['stock'] = self._stock
+        else:
+            state['stock'] = self._stock
+        for (name, part) in parts.items():
+            state.update({name + '.' + key: value
+                          for (key, value) in part.state_dict().items()})
+        return state
+
+    def _set_mutable_state(self, state):
+        if 'stock' in state:
+            self._stock = state['stock']
+        parts = {'buffer': self._buffer, 'buffer_fast': self._buffer_fast}
+        if hasattr(self._stock, 'load_state_dict'):
+            parts['stock'] = self._stock
+        for (name, part) in parts.items():
+            part.load_state_dict({key[len(name) + 1:]: value
+                                  for (key, value) in state.items()
+                                  if key.startswith(name + '.')})
+        self._step_counter = state['step_counter']
+        # States saved before random streams have no episode
+        self._episode = state.get('episode', self._episode)
+        self.day_position = state['day_position']
+        self.forecast = state['forecast']
+        self.real = state['real']
+
+    def _allocateObs(self):
+        # One buffer for all observations, split into views of its segments:
+        # stock, characs, forecast, in transit units and intraday position
+        characs = self.assortment.characs
+        stock_width = self._max_stock if self._observation_mode == 'full' else self._age_bins
+        widths = (stock_width, characs.shape[-1], 1,
+                  self._lead_time + self._lead_time_fast, 1)
+        self._obs = torch.empty(self._batch_shape + (self._assortment_size, sum(widths)))
+        (self._obs_stock, obs_characs, self._obs_forecast, in_transit,
+         self._obs_day) = self._obs.split(widths, -1)
+        obs_characs.copy_(characs.expand_as(obs_characs))
+        # (lead times, *batch, items) like OrderPipeline.pending
+        dims = in_transit.dim()
+        in_transit = in_transit.permute((dims - 1, ) + tuple(range(dims - 1)))
+        (self._obs_transit, self._obs_transit_fast) = \
+            (in_transit[:self._lead_time], in_transit[self._lead_time:])
+
     def _updateObs(self):
-        self._obs = torch.cat((self.stock, self.assortment.characs,
-                               self.forecast, torch.stack(self._buffer
-                                                          + self._buffer_fast, 1),
-                               torch.ones(self._assortment_size, 1)
-                               * self.day_position), 1)
+        if not self._observe:
+            return
+        if self._observation_mode == 'full':
+            self._obs_stock.copy_(self.stock)
+        else:
+            self._obs_stock.copy_(self._stock.age_profile(self._age_bins))
+        self._obs_forecast.copy_(self.forecast)
+        self._buffer.pending(out=self._obs_transit)
+        self._buffer_fast.pending(out=self._obs_transit_fast)
+        self._obs_day.fill_(self.day_position)
 
     def _updateEnv(self):
         self.day_position = 1
-        argument = self._year_multiplier[self._step_counter] \
-            + self._phase
-        argument2 = self._week_multiplier[self._step_counter] \
-            + self._phase2
-        self.forecast = (self.assortment.base_demand
-                         * argument.cos().abs()
-                         * argument2.cos().abs()).view(-1, 1)
-        self.real = self.forecast.view(-1) \
-            + self._bias.sample((self._assortment_size, ))
+        self.forecast = self._seasonality[self._step_counter].unsqueeze(-1)
+        if self._streams is not None:
+            noise = self._streams.rows('noise', self._step_counter, self._episode)
+        else:
+            noise = self._bias.sample(self._batch_shape + (self._assortment_size, ))
+        self.real = self.forecast.squeeze(-1) + noise
         self._updateObs()
 
+    def _createStreams(self, rng, seed=None):
+        if rng == 'global':
+            return None
+        elif rng != 'streams':
+            raise ValueError("Unknown random number generator '{}'".format(rng))
+        if seed is None:
+            seed = self._seed
+        if seed is None:
+            # Still reproducible under torch.manual_seed, and pickled
+            seed = int(torch.randint(2 ** 62, ()))
+        return RandomStreams(seed, self._drawStreams, self._batch_shape, self._stream_days)
+
+    def _drawPhases(self):
+        # Seasonality phases, of every store from its own stream with random streams
+        if self._streams is None:
+            return (2 * pi * torch.rand(self._batch_shape + (self._assortment_size, )),
+                    2 * pi * torch.rand(self._batch_shape + (self._assortment_size, )))
+        phases = []
+        for store in range(int(np.prod(self._batch_shape))):
+            with self._streams.seeded(store, 'phases'):
+                phases.append(2 * pi * torch.rand(2, self._assortment_size))
+        phases = torch.stack(phases, 1).view((2, ) + self._batch_shape + (self._assortment_size, ))
+        return (phases[0], phases[1])
+
+    def _drawStreams(self, store, episode, chunk):
+        # Forecast noise, customers and demand of one store over a chunk of days
+        days = torch.arange(chunk * self._stream_days, (chunk + 1) * self._stream_days)
+        forecast = self._seasonality.compute(days).view(len(days), -1,
+                                                        self._assortment_size)[:, store]
+        with self._streams.seeded(store, episode, 'noise', chunk):
+            noise = self._bias.sample((len(days), self._assortment_size))
+        # Customer buckets are shared by all stores, or given per store
+        buckets = self._customers.event_shape[0]
+        loc = self._customers.loc.reshape(-1, buckets)
+        row = store if len(loc) > 1 else 0
+        customers = d.multivariate_normal.MultivariateNormal(
+            loc[row], scale_tril=self._customers.scale_tril.reshape(-1, buckets, buckets)[row])
+        with self._streams.seeded(store, episode, 'customers', chunk):
+            sampled_customers = customers.sample((len(days), ))
+        sampled_customers = sampled_customers.round()[:, :self._substep_count].clamp(min=0)
+        consumption_prob = (forecast + noise).clamp(0.0, 1.)
+        with self._streams.seeded(store, episode, 'demand', chunk):
+            if isinstance(self._demand, BernoulliDemand):
+                # Draws for a single customer count at a time
+                demand = torch.stack([torch.stack([
+                    self._demand.sample(n, consumption_prob[day]) for n in day_customers])
+                    for (day, day_customers) in enumerate(sampled_customers)])
+            else:
+                demand = self._demand.sample(sampled_customers.unsqueeze(-1),
+                                             consumption_prob.unsqueeze(1))
+        return {'noise': noise, 'demand': demand.clamp(0, self._max_stock)}
+
+    def _streamDemand(self):
+        # Demand of the current step, None without random streams
+        if self._streams is None:
+            return None
+        return self._streams.rows('demand', self._step_counter,
+                                  self._episode)[..., self.day_position - 1, :]
+
+    def _createTransportation(self, carriers):
+        if not carriers:
+            return None
+        # Unit volumes as in transportation_cost
+        transportation = TransportationCost(carriers, self.assortment.dims.sum(-1))
+        # Fails on creation rather than on the first order without a carrier
+        transportation.eligible(self._lead_time)
+        transportation.eligible(self._lead_time_fast)
+        return transportation
+
+    def _createKernel(self, step_kernel):
+        # One-element indices of customer buckets and pipeline slots, see _kernelStep
+        self._indices = torch.arange(max(self._substep_count, self._lead_time + 1,
+                                         self._lead_time_fast + 1)).view(-1, 1)
+        if step_kernel == 'eager':
+            return None
+        elif step_kernel in ('script', 'compile'):
+            return compile_step(self, step_kernel)
+        raise ValueError("Unknown step kernel '{}'".format(step_kernel))
+
+    def _createStock(self, stock_engine):
+        if stock_engine == 'dense':
+            return DenseStock(self.assortment.shelf_lives, self._max_stock)
+        elif stock_engine == 'histogram':
+            return HistogramStock(self.assortment.shelf_lives, self._max_stock)
+        else:
+            return stock_engine(self.assortment.shelf_lives, self._max_stock)
+
     def _addStock(self, units):
-        padding = self._max_stock - units
-        replenishment = torch.stack((units, padding)).t().reshape(-1)
-        restock_matrix = \
-            self._repeater.repeat_interleave(repeats=replenishment.long(),
-                                             dim=0).view(self._assortment_size, self._max_stock)
-        torch.add(self.stock.sort(1)[0], restock_matrix.sort(1,
-                                                             descending=True)[0], out=self.stock)
-        total_units = \
-            restock_matrix.ge(1).sum(1).add_(self.stock.ge(1).sum(1))
-        penalty_cost_forbidden = F.relu(total_units
-                                        - self._max_stock).float().mul_(self.assortment.selling_price)
+        penalty_cost_forbidden = \
+            self._stock.add(units).mul_(self.assortment.selling_price)
         return penalty_cost_forbidden
 
     def _sellUnits(self, units):
-        sold = torch.min(self.stock.ge(1).sum(1).float(), units)
-        availability = \
-            self.stock.ge(1).sum(1).float().div(units).clamp(0, 1)
+        on_hand = self._stock.count()
+        sold = torch.min(on_hand, units)
+        availability = on_hand.div(units).clamp(0, 1)
         availability[torch.isnan(availability)] = 1.
         reward = \
             sold.mul_(2).sub_(units).mul(self.assortment.selling_price
                                          - self.assortment.cost)
-        (p, n) = self.stock.shape
-        stock_vector = self.stock.sort(1, descending=True)[0].view(-1)
-        to_keep = n - units
-
-        # IMPROVE INTERLEAVER SPEED ###
-
-        interleaver = torch.stack((units, to_keep)).t().reshape(2,
-                                                                p).view(-1).long()
-        binary_vec = torch.tensor([0.0,
-                                   1]).repeat(p).repeat_interleave(interleaver)
-        self.stock = binary_vec.mul_(stock_vector).view(p, n)
+        self._stock.remove(units)
         return (reward, availability)
 
     def _waste(self):
-        waste = torch.mul(self.stock.eq(1).sum(1).float(),
+        waste = torch.mul(self._stock.expiring(),
                           self.assortment.selling_price)
         return waste
 
     def _reduceShelfLives(self):
-        self.stock = F.relu(self.stock - 1)
+        self._stock.age()
 
     def _generateDemand(self, consumption_prob):
+        if self._streams is not None:
+            return self._sellUnits(self._streamDemand())
+        # Stores sharing customer buckets still draw their customers independently
+        shared_dims = len(self._batch_shape) - len(self._customers.batch_shape)
         sampled_customers = \
-            self._customers.sample().round().int()[self.day_position
-                                                   - 1]
-        purchases_gen = d.bernoulli.Bernoulli(consumption_prob)
-        demand = purchases_gen.sample((sampled_customers,
-                                       )).sum(0).clamp(0, self._max_stock)
+            self._customers.sample(self._batch_shape[:shared_dims]).round()[..., self.day_position
+                                                                          - 1].clamp(min=0).unsqueeze(-1)
+        demand = self._demand.sample(sampled_customers,
+                                     consumption_prob).clamp(0, self._max_stock)
         (reward, availability) = self._sellUnits(demand)
         return (reward, availability)
 
@@ -253,30 +531,37 @@ class StoreEnv(Env):
     # order speed increases the speed of all orders currently in the buffer.
 
     def _make_order(self, units):
-        self._buffer.append(units.float().view(-1))
-        penaltyCost = self._addStock(self._buffer.pop(0))
+        arrivals = self._buffer.push(units.reshape(self._batch_shape + (-1, )))
+        penaltyCost = self._addStock(arrivals)
+        if self.transportation is not None:
+            penaltyCost += self._shippingCost(units, self._lead_time)
         return penaltyCost
 
     def _make_fast_order(self, units):
-        self._buffer_fast.append(units.float().view(-1))
-        penaltyCost = self._addStock(self._buffer_fast.pop(0))
+        arrivals = self._buffer_fast.push(units.reshape(self._batch_shape + (-1, )))
+        penaltyCost = self._addStock(arrivals)
+        if self.transportation is not None:
+            penaltyCost += self._shippingCost(units, self._lead_time_fast)
         return penaltyCost
 
+    def _shippingCost(self, units, lead_time):
+        # Per-item share of the cheapest carrier mix delivering in time
+        return self.transportation.price(units.reshape(self._batch_shape + (-1, )),
+                                         lead_time).allocation
+
     def get_partial_position(self):
-        return self.stock.ge(1).sum(1).float()
+        return self._stock.count()
 
     def get_full_inventory_position(self):
         ip = self.get_partial_position()
-        ip += torch.stack(self._buffer).sum(0)
+        ip += self._buffer.in_transit
         return ip
 
     def create_buffers(self, slow_speed, fast_speed):
-        self._buffer = []
-        self._buffer_fast = []
-        for i in range(slow_speed):
-            self._buffer.append(torch.zeros(self._assortment_size))
-        for i in range(fast_speed):
-            self._buffer_fast.append(torch.zeros(self._assortment_size))
+        self._buffer = OrderPipeline(slow_speed, self._assortment_size,
+                                     self._batch_shape)
+        self._buffer_fast = OrderPipeline(fast_speed, self._assortment_size,
+                                          self._batch_shape)
 
     def transportation_cost(
         self,
@@ -295,6 +580,10 @@ class StoreEnv(Env):
     # ##########################################################################
     # Properties
 
+    @property
+    def stock(self):
+        return self._stock.matrix()
+
     @property
     def clip_reward(self):
         return self._clip_reward
@@ -302,3 +591,20 @@ class StoreEnv(Env):
     @property
     def horizon(self):
         return self._horizon
+
+
+def plot_daily_rewards(somme):
+    import plotly.express as px
+
+    fig = px.line(x=np.arange(0, len(somme), 1), y=np.round(somme, 2),
+                  title='Daily Utility value',
+                  labels={'x': 'Time step', 'y': 'Utility'})
+    return fig
+
+
+def _copy(value):
+    if isinstance(value, torch.Tensor):
+        return value.clone()
+    elif isinstance(value, (int, float)):
+        return value
+    return copy.deepcopy(value)
@@ -2,6 +2,7 @@ import torch
 import torch.distributions as d
 
 from ..utility import CustomUtility
+from .numpy_store_env import NumpyStoreEnv
 from .store_env import StoreEnv
 
 
@@ -11,11 +12,24 @@ class StoreFactory:
     def create_store_env(cls, n_customers, n_items, max_stock, horizon,
                          freshness, seed, utility_fun, utility, weight_waste,
                          weight_sales, weight_availability, bias, variance,
-                         leadtime_long, leadtime_fast, daily_buckets):
+                         leadtime_long, leadtime_fast, daily_buckets,
+                         backend='torch'):
+        if backend == 'torch':
+            store_class = StoreEnv
+        elif backend == 'numpy':
+            store_class = NumpyStoreEnv
+        else:
+            raise ValueError("Unknown simulation backend '{}'".format(backend))
         if utility_fun == 'custom':
             utility_fun = CustomUtility(utility)
-        bucketDist = d.uniform.Uniform(0, 1)
-        sampled = bucketDist.sample((daily_buckets,))
+        if seed is None:
+            bucketDist = d.uniform.Uniform(0, 1)
+            sampled = bucketDist.sample((daily_buckets,))
+        else:
+            # Seeded stores are fully determined by these arguments
+            generator = torch.Generator()
+            generator.manual_seed(seed)
+            sampled = torch.rand(daily_buckets, generator=generator)
         store_kwargs = {
             'bucket_customers': (n_customers*sampled/sampled.sum()).round(),
             'assortment_size': n_items,
@@ -36,4 +50,7 @@ class StoreFactory:
             'substep_count': daily_buckets,
             'bucket_cov': torch.eye(daily_buckets) / 100,
         }
-        return StoreEnv(**store_kwargs)
+        with torch.random.fork_rng(devices=[], enabled=seed is not None):
+            if seed is not None:
+                torch.manual_seed(seed)
+            return store_class(**store_kwargs)
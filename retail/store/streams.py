@@ -0,0 +1,63 @@
+import contextlib
+import hashlib
+
+import torch
+
+
+class RandomStreams:
+    """Random draws of every store, episode and day, sampled in bulk by chunks of days.
+
+    A chunk of stream `name` is drawn from the global torch RNG seeded with a hash
+    of (seed, store, episode, name, chunk), whose state is restored afterwards,
+    so that draws only depend on these counters: not on the order in which they
+    are made, on other stores or streams, on the process or on the actions taken.
+    seeded gives such draws for any other counters, such as per-store constants.
+    Stores created with the same seed then see the same random draws whatever
+    their policies, common random numbers that make comparing policies need far
+    fewer replications, as long as they also share chunk_days, which sets the
+    draws of every chunk. draw(store, episode, chunk) returns the (days, ...)
+    tensors of a chunk by stream name, see StoreEnv._drawStreams, and rows gives
+    those of the current day of every store.
+    """
+
+    def __init__(self, seed, draw, batch_shape=(), chunk_days=28):
+        self.seed = seed
+        self.chunk_days = chunk_days
+        self._draw = draw
+        self._batch_shape = tuple(batch_shape)
+        stores = 1
+        for size in self._batch_shape:
+            stores *= size
+        self._stores = torch.arange(stores)
+        # (episode, chunk) held by every store, and its rows by stream
+        self._keys = [None] * stores
+        self._rows = {}
+
+    def seed_of(self, *counters):
+        key = ':'.join(str(counter) for counter in (self.seed, ) + counters)
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little')
+
+    @contextlib.contextmanager
+    def seeded(self, *counters):
+        """Draws from the global RNG seeded by counters, leaving its state untouched"""
+        with torch.random.fork_rng(devices=[]):
+            torch.manual_seed(self.seed_of(*counters))
+            yield
+
+    def rows(self, name, days, episodes):
+        """(*batch, ...) draws of stream name on the day of the episode of every store"""
+        days = torch.as_tensor(days).expand(self._batch_shape).reshape(-1)
+        episodes = torch.as_tensor(episodes).expand(self._batch_shape).reshape(-1)
+        chunks = days // self.chunk_days
+        for (store, key) in enumerate(zip(episodes.tolist(), chunks.tolist())):
+            if self._keys[store] != key:
+                self._fill(store, *key)
+        rows = self._rows[name][self._stores, days % self.chunk_days]
+        return rows.view(self._batch_shape + rows.shape[1:])
+
+    def _fill(self, store, episode, chunk):
+        for (name, values) in self._draw(store, episode, chunk).items():
+            if name not in self._rows:
+                self._rows[name] = values.new_empty((len(self._stores), ) + values.shape)
+            self._rows[name][store] = values
+        self._keys[store] = (episode, chunk)
@@ -0,0 +1,79 @@
+from collections import namedtuple
+
+import torch
+
+
+Carrier = namedtuple('Carrier', ['capacity', 'cost', 'lead_time'])
+
+# Costs of plans with leading dimensions P over C carriers, see TransportationCost.price
+Costing = namedtuple('Costing', ['volume', 'carrier_cost', 'mix_cost', 'cost',
+                                 'primary', 'remainder', 'allocation'])
+
+
+class TransportationCost:
+    """Prices order plans over several carriers in one batched computation.
+
+    A carrier ships up to `capacity` volume per truck, and trucks are paid
+    `cost` in full as soon as they carry anything. A plan ships either on
+    trucks of a single carrier, or on full trucks of a primary carrier with the
+    remainder on another one, and price keeps the cheapest of these mixes. Plans
+    are units per item with any leading dimensions, such as candidate plans and
+    stores, so that many plans are scored without Python loops. Costs are
+    allocated to items in proportion to the volume they ship.
+    """
+
+    def __init__(self, carriers, volumes):
+        self.carriers = tuple(Carrier(**c) if isinstance(c, dict) else Carrier(*c)
+                              for c in carriers)
+        if not self.carriers:
+            raise ValueError('TransportationCost needs at least one carrier')
+        self.volumes = torch.as_tensor(volumes).float()
+        self.capacity = torch.tensor([float(c.capacity) for c in self.carriers])
+        self.fixed_cost = torch.tensor([float(c.cost) for c in self.carriers])
+        self.lead_time = torch.tensor([int(c.lead_time) for c in self.carriers])
+
+    def eligible(self, lead_time=None):
+        """Mask of the carriers delivering within lead_time, all of them by default"""
+        if lead_time is None:
+            return torch.ones(len(self.carriers), dtype=torch.bool)
+        eligible = self.lead_time.le(lead_time)
+        if not eligible.any():
+            raise ValueError('No carrier delivers within {} steps'.format(lead_time))
+        return eligible
+
+    def price(self, plans, lead_time=None):
+        """Costing of (*P, items) plans over the carriers delivering within lead_time.
+
+        carrier_cost is (*P, C), the cost of shipping on a single carrier,
+        infinite for ineligible ones. mix_cost is (*P, C, C), full trucks of the
+        primary carrier and the remainder on the other, its diagonal being
+        carrier_cost. cost, primary and remainder give the cheapest mix of
+        every plan, and allocation its (*P, items) per-item share.
+        """
+        plans = torch.as_tensor(plans).float()
+        volume = plans.matmul(self.volumes)
+        eligible = self.eligible(lead_time)
+        loads = volume.unsqueeze(-1) / self.capacity
+        carrier_cost = loads.ceil() * self.fixed_cost
+        full = loads.floor()
+        rest = (volume.unsqueeze(-1) - full * self.capacity).clamp_(min=0)
+        mix_cost = (full * self.fixed_cost).unsqueeze(-1) \
+            + (rest.unsqueeze(-1) / self.capacity).ceil_() * self.fixed_cost
+        infinity = torch.tensor(float('inf'))
+        carrier_cost = torch.where(eligible, carrier_cost, infinity)
+        mix_cost = torch.where(eligible.unsqueeze(-1) & eligible, mix_cost, infinity)
+        (cheapest, remainders) = mix_cost.min(-1)
+        (cost, primary) = cheapest.min(-1)
+        return Costing(volume=volume, carrier_cost=carrier_cost,
+                       mix_cost=mix_cost, cost=cost, primary=primary,
+                       remainder=remainders.gather(-1, primary.unsqueeze(-1)).squeeze(-1),
+                       allocation=self.allocate(plans, cost, volume))
+
+    def allocate(self, plans, cost, volume=None):
+        """(*P, items) shares of the (*P) plan costs, by shipped volume"""
+        plans = torch.as_tensor(plans).float()
+        if volume is None:
+            volume = plans.matmul(self.volumes)
+        share = plans * self.volumes / volume.unsqueeze(-1)
+        share[torch.isnan(share)] = 0.
+        return share * cost.unsqueeze(-1)
@@ -3,8 +3,9 @@ from rpy2.robjects.packages import importr
 
 
 
-def Rscript(size, seed, path):
+def Rscript(size, seed, path, out_path=None):
     """assortmentGen.R script"""
+    out_path = path if out_path is None else out_path
     robjects.r(f'NUMBER_OF_ITEMS <- as.numeric({size})')
 
     # Load model
@@ -20,4 +21,28 @@ def Rscript(size, seed, path):
 
     # Round shelf life to obtain at least 1 for every item
     robjects.r('items$Shelf_life <- ceiling(items$Shelf_life)')
-    robjects.r(f'write.csv(items, paste0("{path}","/assortment.csv"))')
+    robjects.r(f'write.csv(items, paste0("{out_path}","/assortment.csv"))')
+
+
+def Rexport(path, grid_size=1025, bound=16.):
+    """Export assortmentCopula to copulaModel.npz for the native sampler"""
+    import numpy as np
+
+    importr("copula")
+    robjects.r(f'load(paste0("{path}","/copulaModel.RData"))')
+
+    # Margins are tabulated on a grid regular in logit(u), which keeps the tails accurate
+    logits = np.linspace(-bound, bound, grid_size)
+    robjects.globalenv['u'] = robjects.FloatVector(1 / (1 + np.exp(-logits)))
+    margins = list(robjects.r('assortmentCopula@margins'))
+    params = [list(robjects.r(f'unlist(assortmentCopula@paramMargins[[{i + 1}]])'))
+              for i in range(len(margins))]
+    quantiles = [np.array(robjects.r(f'do.call(paste0("q", assortmentCopula@margins[{i + 1}]), '
+                                     f'c(list(u), assortmentCopula@paramMargins[[{i + 1}]]))'))
+                 for i in range(len(margins))]
+    np.savez(f'{path}/copulaModel.npz',
+             family=np.array(robjects.r('class(assortmentCopula@copula)')[0]),
+             theta=np.array(robjects.r('assortmentCopula@copula@parameters')[0]),
+             columns=np.array(["Length", "Depth", "Height", "Shelf_life", "Base_Demand", "Cost", "Price"]),
+             margins=np.array(margins), params=np.array(params),
+             logits=logits, quantiles=np.array(quantiles))
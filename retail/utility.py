@@ -1,7 +1,36 @@
+import math
+
 from rlpyt.utils.quick_args import save__init__args
+import numpy as np
 import torch
 import torch.nn.functional as F
 
+from retail.expression import UTILITY_VARIABLES, compile_expression
+
+
+# Rewards take tensors, or arrays from NumpyStoreEnv. Transcendental functions
+# of arrays run in torch on the same memory, as NumPy rounds them differently.
+
+def _relu(x):
+    if isinstance(x, np.ndarray):
+        return np.maximum(x, 0.)
+    return F.relu(x)
+
+
+def _log(x):
+    if isinstance(x, np.ndarray):
+        return torch.log(torch.from_numpy(x)).numpy()
+    elif isinstance(x, torch.Tensor):
+        return torch.log(x)
+    return math.log(x)
+
+
+def _pow(x, exponent):
+    if isinstance(x, np.ndarray):
+        return torch.pow(torch.from_numpy(x), exponent).numpy()
+    return x ** exponent
+
+
 class LinearUtility:
 
     def __init__(
@@ -38,8 +67,8 @@ class CobbDouglasUtility:
         waste,
         availability,
     ):
-        return F.relu(sales) ** self._alpha * (1 + waste) ** -self._beta \
-            * availability ** self._gamma
+        return _pow(_relu(sales), self._alpha) * _pow(1 + waste, -self._beta) \
+            * _pow(availability, self._gamma)
 
 
 class LogLinearUtility:
@@ -58,8 +87,8 @@ class LogLinearUtility:
         waste,
         availability,
     ):
-        return torch.log(1 + F.relu(sales)) * self._alpha \
-        - torch.log(torch.tensor(1. + waste)) * self._beta + torch.log(1.
+        return _log(1 + _relu(sales)) * self._alpha \
+        - _log(1. + waste) * self._beta + _log(1.
         + availability) * self._gamma
 
 
@@ -79,13 +108,18 @@ class HomogeneousReward:
         waste,
         availability,
     ):
-        return (availability ** self._gamma * (sales - waste)).squeeze()
+        return (_pow(availability, self._gamma) * (sales - waste)).squeeze()
 
 
 class CustomUtility:
 
     def __init__(self, utility):
+        # Raises ValueError for invalid expressions when the store is created
         self.txt = utility
+        self._expression = compile_expression(utility, UTILITY_VARIABLES)
 
     def reward(self, s, w, a):
-        return eval(self.txt)
+        # Expressions mix operators and torch functions, arrays share their memory
+        (s, w, a) = (torch.from_numpy(x) if isinstance(x, np.ndarray) else x
+                     for x in (s, w, a))
+        return self._expression(s=s, w=w, a=a)
@@ -10,11 +10,16 @@ REQUIRES = [
     "pandas==0.25.1",
     "pymemcache==3.4.0",
     "rlpyt",
-    "rpy2==3.3.6",
     "torch==1.4.0",
 ]
 
 
+# Only needed for the reference assortment backend and util.Rexport
+EXTRAS = {
+    "r": ["rpy2==3.3.6"],
+}
+
+
 DEPENDENCY_LINKS = [
     "git+https://github.com/astooke/rlpyt.git@f04f23d#egg=rlpyt-0.1.1.dev0",
 ]
@@ -29,5 +34,6 @@ setup(
     url="https://github.com/samijullien/airlab-retail",
     license="MIT",
     install_requires=REQUIRES,
+    extras_require=EXTRAS,
     dependency_links=DEPENDENCY_LINKS,
 )
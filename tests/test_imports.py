@@ -0,0 +1,5 @@
+from benchmarks.imports import check
+
+
+def test_core_imports_within_budget():
+    assert check(budget=.5, repeat=2) == []
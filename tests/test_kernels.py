@@ -0,0 +1,23 @@
+import itertools
+
+import pytest
+import torch
+
+from benchmarks.store_env import check_parity
+
+
+@pytest.mark.parametrize('stock_engine,demand_model,utility_function', itertools.product(
+    ['dense', 'histogram'], ['binomial', 'poisson'],
+    ['linear', 'loglinear', 'cobbdouglas', 'homogeneous']))
+def test_script_kernel_matches_eager(stock_engine, demand_model, utility_function):
+    config = dict(step_kernel='script', stock_engine=stock_engine, demand_model=demand_model,
+                  utility_function=utility_function, lead_time_fast=0)
+    assert check_parity(config, steps=20) is None
+
+
+@pytest.mark.skipif(not hasattr(torch, 'compile'), reason='torch.compile needs torch 2')
+@pytest.mark.parametrize('stock_engine', ['dense', 'histogram'])
+def test_compiled_kernel_matches_eager(stock_engine):
+    config = dict(step_kernel='compile', stock_engine=stock_engine, demand_model='binomial',
+                  utility_function='homogeneous', lead_time_fast=1)
+    assert check_parity(config, steps=20) is None
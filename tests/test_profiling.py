@@ -0,0 +1,15 @@
+import torch
+
+from retail.store.profiling import StepProfiler
+from retail.store.store_env import StoreEnv
+
+
+def test_fork_while_profiling_steps_the_fork():
+    env = StoreEnv(assortment_size=10, max_stock=20, seed=1)
+    with StepProfiler(env) as profiler:
+        fork = env.fork()[0]
+        for _ in range(env._substep_count):
+            fork.step(torch.full((10, ), 5.))
+    assert (fork._step_counter, env._step_counter) == (1, 0)
+    assert env.day_position == 1
+    assert 'step' not in profiler.stats()
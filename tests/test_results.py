@@ -0,0 +1,43 @@
+import pytest
+import torch
+
+from retail.results import ResultCache
+from retail.store.store_factory import StoreFactory
+
+ORDER = 'forecast*n_customers - stock'
+
+
+def _store(backend='torch', seed=1):
+    return StoreFactory.create_store_env(
+        n_customers=100, n_items=10, max_stock=20, horizon=30, freshness=3,
+        seed=seed, utility_fun='homogeneous', utility=None, weight_waste=.5,
+        weight_sales=.5, weight_availability=.5, bias=0, variance=0,
+        leadtime_long=1, leadtime_fast=0, daily_buckets=3, backend=backend)
+
+
+def _stepped(store):
+    for _ in range(store._substep_count):
+        store.step(torch.full((10, ), 5.))
+    return store
+
+
+@pytest.mark.parametrize('backend', ['torch', 'numpy'])
+def test_key_follows_store_state(backend):
+    results = ResultCache(cache=None)
+    key = results.key(_store(backend), ORDER, 100)
+    assert results.key(_store(backend), ORDER, 100) == key
+    assert results.key(_store(backend, seed=None), ORDER, 100) is None
+
+    store = _store(backend)
+    snapshot = store.snapshot()
+    _stepped(store)
+    assert results.key(store, ORDER, 100) != key
+    store.restore(snapshot)
+    assert results.key(store, ORDER, 100) == key
+
+    fork = _stepped(_store(backend).fork()[0])
+    assert results.key(fork, ORDER, 100) not in (key, None)
+
+    store = _store(backend)
+    store._phase = store._phase + 1
+    assert results.key(store, ORDER, 100) != key